@@ -10,6 +10,8 @@ MODEL_FILENAME = "model.ckpt"
 PRETRAINED_MODEL = "./pretrained/lpd.t7"
 
 DATASET_FOLDER = '../benchmark_datasets/'
+# 打包后的float32子图仓库，为空则逐个读取.bin
+PC_STORE_FOLDER = ''
 
 # TRAIN
 BATCH_NUM_QUERIES = 2
@@ -31,10 +33,10 @@ BN_DECAY_CLIP = 0.99
 
 RESUME = False
 
-TRAIN_FILE = 'generating_queries/training_queries_baseline.pickle'
-TEST_FILE = 'generating_queries/test_queries_baseline.pickle'
-TRAIN_FILE_EASY = 'generating_queries/copy/training_queries_baseline.pickle'
-TEST_FILE_EASY = 'generating_queries/copy/test_queries_baseline.pickle'
+TRAIN_FILE = 'generating_queries/training_queries_baseline.npz'
+TEST_FILE = 'generating_queries/test_queries_baseline.npz'
+TRAIN_FILE_EASY = 'generating_queries/copy/training_queries_baseline.npz'
+TEST_FILE_EASY = 'generating_queries/copy/test_queries_baseline.npz'
 
 # LOSS
 LOSS_FUNCTION = 'quadruplet'
@@ -49,6 +51,8 @@ EVAL_NEGATIVES_PER_QUERY = 12
 
 EVAL_DATABASE_FILE = 'generating_queries/oxford_evaluation_database.pickle'
 EVAL_QUERY_FILE = 'generating_queries/oxford_evaluation_query.pickle'
+EVAL_DATABASE_PATTERN = 'generating_queries/{}_evaluation_database.pickle'
+EVAL_QUERY_PATTERN = 'generating_queries/{}_evaluation_query.pickle'
 
 
 def cfg_str():
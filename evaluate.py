@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
-import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 import torch
 import torch.nn as nn
 from torch.backends import cudnn
@@ -13,6 +13,9 @@ from loading_pointclouds import *
 import util.PointNetVlad as PNV
 import config as cfg
 from util.initPara import log_string
+from util.descriptor_cache import DescriptorCache, model_hash
+from util.pipeline import embed
+from util.distributed import unwrap
 
 cudnn.enabled = True
 
@@ -25,18 +28,10 @@ cfg.EVAL_QUERY_FILE = 'generating_queries/oxford_evaluation_query.pickle'
 DATABASE_SETS = get_sets_dict(cfg.EVAL_DATABASE_FILE)
 QUERY_SETS = get_sets_dict(cfg.EVAL_QUERY_FILE)
 
-LOG_FOUT = open(os.path.join(para.args.log_dir, 'log_train.txt'), 'w')
-LOG_FOUT.write(str(para.args) + '\n')
-LOG_FOUT.flush()
+# 日志写入initPara打开的LOG_FOUT，这里再以'w'打开会截断它（多进程时还会截断rank 0的日志）
 TOTAL_ITERATIONS = 0
 
-def evaluate_model(model, tqdm_flag=True):
-    # 计算 Recall @N
-    recall = np.zeros(recall_num)
-    count = 0
-    similarity = []
-    one_percent_recall = []
-
+def evaluate_model(model, tqdm_flag=True, with_recall=False):
     DATABASE_VECTORS = []
     QUERY_VECTORS = []
 
@@ -46,29 +41,96 @@ def evaluate_model(model, tqdm_flag=True):
     else:
         fun_tqdm = list
 
+    cache = get_descriptor_cache(model, tqdm_flag)
+
     # 总共23个子图
     # 获得每个子地图的每一帧点云的描述子
     for i in fun_tqdm(range(len(DATABASE_SETS))):
-        DATABASE_VECTORS.append(get_latent_vectors(model, DATABASE_SETS[i]))
+        DATABASE_VECTORS.append(get_latent_vectors(model, DATABASE_SETS[i], cache))
 
     # 获得每个子地图的每一帧要被评估的点云的描述子
     for j in fun_tqdm(range(len(QUERY_SETS))):
-        QUERY_VECTORS.append(get_latent_vectors(model, QUERY_SETS[j]))
+        QUERY_VECTORS.append(get_latent_vectors(model, QUERY_SETS[j], cache))
+
+    if cache is not None:
+        cache.save()
 
     torch.cuda.empty_cache()
-    for m in fun_tqdm(range(len(QUERY_SETS))):
-        for n in range(len(QUERY_SETS)):
-            if (m == n):
-                continue
-            # 寻找当前第m个子图和第n个子图的检索结果
-            pair_recall, pair_similarity, pair_opr = get_recall(
-                m, n, DATABASE_VECTORS, QUERY_VECTORS, QUERY_SETS)
-            recall += np.array(pair_recall)
-            count += 1
-            one_percent_recall.append(pair_opr)
-            for x in pair_similarity:
-                similarity.append(x)
+    return evaluate_vectors(DATABASE_VECTORS, QUERY_VECTORS, QUERY_SETS, tqdm_flag, with_recall)
+
+
+def evaluate_quantized(model, calib_clouds, tolerance=0.0, tqdm_flag=True):
+    # 分别以fp32和cpu上的动态int8评估model并记录recall的下降，calib_clouds [N,num_points,3]用于测量逐层误差；返回int8模型
+    from util.quantize import quantize_model
+    log_string("evaluate fp32 model", print_flag=tqdm_flag)
+    fp32 = evaluate_model(model, tqdm_flag, with_recall=True)
+    quantized, names = quantize_model(model, calib_clouds, tolerance,
+                                      log_fn=lambda s: log_string(s, print_flag=tqdm_flag))
+    log_string("int8 layers: " + str(len(names)), print_flag=tqdm_flag)
+    log_string("evaluate int8 model", print_flag=tqdm_flag)
+    int8 = evaluate_model(quantized, tqdm_flag, with_recall=True)
+
+    log_string("        recall@1  one_percent_recall", print_flag=tqdm_flag)
+    for name, result in (("fp32", fp32), ("int8", int8)):
+        log_string("%s    %.2f     %.2f" % (name, result[3][0], result[2]), print_flag=tqdm_flag)
+    log_string("drop    %.2f     %.2f" % (fp32[3][0] - int8[3][0], fp32[2] - int8[2]), print_flag=tqdm_flag)
+    return quantized
+
+
+def evaluate_benchmarks(model, benchmarks, tqdm_flag=True):
+    # 一次评估多个benchmark（oxford university residential business）：所有benchmark中不重复的子图只计算一次描述子，再分别计算recall
+    # 返回{name: (ave_recall, average_similarity_score, ave_one_percent_recall)}
+    benchmark_sets = []
+    file_names = []
+    for name in benchmarks:
+        database_sets = get_sets_dict(cfg.EVAL_DATABASE_PATTERN.format(name))
+        query_sets = get_sets_dict(cfg.EVAL_QUERY_PATTERN.format(name))
+        benchmark_sets.append((name, database_sets, query_sets))
+        for trajectory in database_sets + query_sets:
+            file_names.extend(trajectory[index]["query"] for index in range(len(trajectory.keys())))
+    # 不同benchmark共用的子图只算一次
+    file_names = list(dict.fromkeys(file_names))
+    log_string("benchmarks " + str(benchmarks) + " unique submaps: " + str(len(file_names)), print_flag=tqdm_flag)
+
+    torch.cuda.empty_cache()
+    cache = get_descriptor_cache(model, tqdm_flag)
+    vectors = get_vectors(model, file_names, cache)
+    if cache is not None:
+        cache.save()
+    rows = {file_name: row for row, file_name in enumerate(file_names)}
+
+    results = {}
+    for name, database_sets, query_sets in benchmark_sets:
+        log_string("benchmark: " + name, print_flag=tqdm_flag)
+        DATABASE_VECTORS = [vectors[[rows[trajectory[index]["query"]] for index in range(len(trajectory.keys()))]]
+                            for trajectory in database_sets]
+        QUERY_VECTORS = [vectors[[rows[trajectory[index]["query"]] for index in range(len(trajectory.keys()))]]
+                         for trajectory in query_sets]
+        results[name] = evaluate_vectors(DATABASE_VECTORS, QUERY_VECTORS, query_sets, tqdm_flag)
+    return results
+
+
+def evaluate_vectors(DATABASE_VECTORS, QUERY_VECTORS, QUERY_SETS, tqdm_flag=True, with_recall=False):
+    # with_recall时额外返回recall@1..recall@N
+    # 计算 Recall @N
+    recall = np.zeros(recall_num)
+    count = 0
+    similarity = []
+    one_percent_recall = []
 
+    if tqdm_flag:
+        fun_tqdm = tqdm
+    else:
+        fun_tqdm = list
+
+    for pair_recall, pair_similarity, pair_opr in get_all_recalls(DATABASE_VECTORS, QUERY_VECTORS, QUERY_SETS, fun_tqdm):
+        recall += np.array(pair_recall)
+        count += 1
+        one_percent_recall.append(pair_opr)
+        for x in pair_similarity:
+            similarity.append(x)
+
+    log_string("recall@N: " + str(np.round(recall / count, 2).tolist()), print_flag=tqdm_flag)
     # 不求均值就可以得到@N的recall
     ave_recall = np.mean(np.mean(recall / count))
     if tqdm_flag:
@@ -90,117 +152,118 @@ def evaluate_model(model, tqdm_flag=True):
     else:
         log_string("ave_one_percent_recall: "+str(ave_one_percent_recall), print_flag=False)
 
+    if with_recall:
+        return ave_recall, average_similarity_score, ave_one_percent_recall, recall / count
     return ave_recall, average_similarity_score, ave_one_percent_recall
 
 
-def get_latent_vectors(model, dict_to_process):
+def get_descriptor_cache(model, tqdm_flag=True):
+    # 同一个checkpoint的描述子只计算一次，保存在磁盘上
+    if not para.args.desc_cache:
+        return None
+    # --amp改变描述子但不改变权重，精度也作为key的一部分；fp32的key与之前的缓存相同
+    amp_dtype = getattr(unwrap(model), 'amp_dtype', None)
+    cache = DescriptorCache(para.args.desc_cache, model_hash(model, extra=str(amp_dtype) if amp_dtype is not None else ""))
+    log_string("descriptor cache " + cache.folder + " " + str(len(cache)), print_flag=tqdm_flag)
+    return cache
+
+
+def get_latent_vectors(model, dict_to_process, cache=None):
+    file_names = [dict_to_process[index]["query"] for index in range(len(dict_to_process.keys()))]
+    return get_vectors(model, file_names, cache)
+
+
+def get_vectors(model, file_names, cache=None):
+    if cache is None:
+        return get_file_vectors(model, file_names)
+    # 只对缓存中没有的子图跑网络
+    q_output, missing = cache.lookup(file_names)
+    if missing.any():
+        missing_names = [file_names[index] for index in np.flatnonzero(missing)]
+        cache.add(missing_names, get_file_vectors(model, missing_names))
+        q_output, missing = cache.lookup(file_names)
+    return q_output
+
+
+def get_file_vectors(model, file_names):
     model.eval()
-    torch.cuda.empty_cache()
-    train_file_idxs = np.arange(0, len(dict_to_process.keys()))
 
     batch_num = para.args.eval_batch_size * \
         (1 + para.args.positives_per_query + para.args.negatives_per_query)
-    q_output = []
-    for q_index in range(len(train_file_idxs)//batch_num):
-        file_indices = train_file_idxs[q_index *
-                                       batch_num:(q_index+1)*(batch_num)]
-        file_names = []
-        for index in file_indices:
-            file_names.append(dict_to_process[index]["query"])
-        start = time()
-        queries = load_pc_files(file_names)
-        # print("load time: ", time() - start)
-        start = time()
-        with torch.no_grad():
-            feed_tensor = torch.from_numpy(queries).float()
-            feed_tensor = feed_tensor.unsqueeze(1)
-            feed_tensor = feed_tensor.to(device)
-            # print(feed_tensor.mean(dim=[0, 1, 2]))
-            out = model(feed_tensor)
-        # print("forward time: ", time() - start)
-
-        out = out.detach().cpu().numpy()
-        out = np.squeeze(out)
-        # del feed_tensor
-        #out = np.vstack((o1, o2, o3, o4))
-        q_output.append(out)
-
-    q_output = np.array(q_output)
-    if(len(q_output) != 0):
-        q_output = q_output.reshape(-1, q_output.shape[-1])
-
-    # handle edge case
-    index_edge = len(train_file_idxs) // batch_num * batch_num
-    if index_edge < len(dict_to_process.keys()):
-        file_indices = train_file_idxs[index_edge:len(dict_to_process.keys())]
-        file_names = []
-        for index in file_indices:
-            file_names.append(dict_to_process[index]["query"])
-        queries = load_pc_files(file_names)
-
-        with torch.no_grad():
-            feed_tensor = torch.from_numpy(queries).float()
-            feed_tensor = feed_tensor.unsqueeze(1)
-            feed_tensor = feed_tensor.to(device)
-            output = model(feed_tensor)
-
-        # del feed_tensor
-        output = output.detach().cpu().numpy()
-        output = np.squeeze(output)
-        if (q_output.shape[0] != 0):
-            q_output = np.vstack((q_output, output))
-        else:
-            q_output = output
+    # 后台线程预读下一批子图，和当前batch的前向计算重叠
+    # int8模型只能在cpu上运行，跟随模型参数所在的设备
+    q_output = embed(model, lambda s: load_pc_files(file_names[s]), len(file_names), batch_num,
+                     next(model.parameters()).device,
+                     depth=para.args.prefetch_depth, num_threads=para.args.loader_threads)
 
-    torch.cuda.empty_cache()
     model.train()
-    # print(q_output.shape)
-    # print(q_output.shape, np.asarray(q_output).mean(),np.asarray(q_output).reshape(-1,256).min(),np.asarray(q_output).reshape(-1,256).max())
     return q_output
 
 
-def get_recall(m, n, DATABASE_VECTORS, QUERY_VECTORS, QUERY_SETS):
+def get_all_recalls(DATABASE_VECTORS, QUERY_VECTORS, QUERY_SETS, fun_tqdm=list):
+    # 每对(数据库m, query集合n != m)的结果，按m、n排序；每个数据库只建一次KDTree，--eval_workers时分配到进程池
+    tasks = []
+    for m in range(len(QUERY_SETS)):
+        # 每个子图只需要第m个数据库的真值
+        true_neighbors = [[QUERY_SETS[n][i][m] for i in range(len(QUERY_VECTORS[n]))] if n != m else []
+                          for n in range(len(QUERY_SETS))]
+        tasks.append((m, DATABASE_VECTORS[m], QUERY_VECTORS, true_neighbors))
+
+    if para.args.eval_workers > 0:
+        with ProcessPoolExecutor(max_workers=para.args.eval_workers) as executor:
+            database_results = list(fun_tqdm(executor.map(get_database_recalls, tasks)))
+    else:
+        database_results = [get_database_recalls(task) for task in fun_tqdm(tasks)]
+    return [result for results in database_results for result in results]
 
-    database_output = DATABASE_VECTORS[m]
-    queries_output = QUERY_VECTORS[n]
 
-    # print(len(queries_output))
+def get_database_recalls(task):
+    # 第m个数据库建一次KDTree，其他所有子图的query拼起来一次检索
+    m, database_output, QUERY_VECTORS, true_neighbors = task
     database_nbrs = KDTree(database_output)
+    others = [n for n in range(len(QUERY_VECTORS)) if n != m]
+    queries_output = np.concatenate([QUERY_VECTORS[n] for n in others])
+    distances, indices = database_nbrs.query(queries_output, k=recall_num)
+
+    results = []
+    start = 0
+    for n in others:
+        end = start + len(QUERY_VECTORS[n])
+        results.append(compute_recall(indices[start:end], database_output, QUERY_VECTORS[n], true_neighbors[n]))
+        start = end
+    return results
+
+
+def compute_recall(indices, database_output, queries_output, true_neighbors):
+    # 一对(数据库, query)的recall@1..recall_num、top-1相似度和百分之一recall
+    # indices为检索到的数据库行 [num_queries, recall_num]，没有真值的query不参与评估
+    # 真值补齐成矩阵，空位填-1
+    lengths = np.array([len(t) for t in true_neighbors], dtype=np.int64)
+    ground_truth = np.full((len(true_neighbors), max(lengths.max(initial=0), 1)), -1, dtype=np.int64)
+    rows = np.repeat(np.arange(len(true_neighbors)), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    if len(rows) > 0:
+        ground_truth[rows, cols] = np.concatenate([np.asarray(t, dtype=np.int64) for t in true_neighbors])
+    # 被评估数
+    evaluated = lengths > 0
+    num_evaluated = np.sum(evaluated)
+
+    # hits[i, j]: 第i个query的第j个候选是真实值
+    hits = (indices[:, :, None] == ground_truth[:, None, :]).any(axis=2) & evaluated[:, None]
+    found = hits.any(axis=1)
+    first = hits.argmax(axis=1)
+    # 只记第一个命中的位置，之后用cumsum得到前j个
+    recall = np.bincount(first[found], minlength=recall_num)[:recall_num]
+
+    top1 = found & (first == 0)
+    top1_similarity_score = np.einsum('ij,ij->i', queries_output[top1],
+                                      database_output[indices[top1, 0]]).tolist()
 
-    recall = [0] * recall_num
-    top1_similarity_score = []
-    one_percent_retrieved = 0
     # threshold之内对应百分之一
     threshold = max(int(round(len(database_output)/100.0)), 1)
-
-    num_evaluated = 0
-    # 遍历需要被评估的点云
-    for i in range(len(queries_output)):
-        # 得到该点云在第m个子图的真实检索点云序列
-        true_neighbors = QUERY_SETS[n][i][m]
-        if(len(true_neighbors) == 0):
-            continue
-        # 被评估数
-        num_evaluated += 1
-        # 得到该点云在第m个子图的实际检索点云序列
-        distances, indices = database_nbrs.query(
-            np.array([queries_output[i]]),k=recall_num)
-        # 遍历recal_num得到在不同指标下的结果
-        for j in range(len(indices[0])):
-            # 如果第j个候选是真实值
-            if indices[0][j] in true_neighbors:
-                # 如果是top1 recall
-                if(j == 0):
-                    similarity = np.dot(queries_output[i], database_output[indices[0][j]])
-                    top1_similarity_score.append(similarity)
-                # 如果第j个候选是真实值，+1
-                recall[j] += 1
-                break
-        # 如果前百分之一包含真实值，+1
-        if len(list(set(indices[0][0:threshold]).intersection(set(true_neighbors)))) > 0:
-            one_percent_retrieved += 1
+    one_percent_retrieved = np.sum(hits[:, :threshold].any(axis=1))
 
     one_percent_recall = (one_percent_retrieved/float(num_evaluated))*100
     # 这里用cumsum因为第j个元素只代表第j个，不代表前j个
     recall = (np.cumsum(recall)/float(num_evaluated))*100
-    return recall, top1_similarity_score, one_percent_recall
\ No newline at end of file
+    return recall, top1_similarity_score, one_percent_recall
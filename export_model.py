@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+from util.inference import model_config, load_checkpoint, export
+
+# 把checkpoint导出成TorchScript/ONNX，用util/inference.py中的DescriptorExtractor加载
+parser = argparse.ArgumentParser()
+parser.add_argument('--pretrained_path', required=True,
+                    help='Checkpoint (.ckpt) or state dict (.t7) to export')
+parser.add_argument('--torchscript', default='',
+                    help='Output TorchScript file (.pt)')
+parser.add_argument('--onnx', default='',
+                    help='Output ONNX file (.onnx)')
+parser.add_argument('--featnet', type=str, default='lpdnetorigin',
+                    help='feature net')
+parser.add_argument('--emb_dims', type=int, default=1024)
+parser.add_argument('--num_points', type=int, default=4096,
+                    help='num_points [default: 4096]')
+parser.add_argument('--fstn', action='store_true', default=False,
+                    help='feature transform')
+parser.add_argument('--xyzstn', action='store_true', default=False,
+                    help='feature transform')
+parser.add_argument('--vlad_rank', type=int, default=0,
+                    help='Rank of the factorized NetVLAD hidden weights [default: 0, full]')
+parser.add_argument('--batch_size', type=int, default=2,
+                    help='Batch size of the tracing input [default: 2]')
+parser.add_argument('--opset', type=int, default=11,
+                    help='ONNX opset version [default: 11]')
+args = parser.parse_args()
+
+if not args.torchscript and not args.onnx:
+    parser.error('nothing to export, pass --torchscript and/or --onnx')
+
+# grid_knn的分支依赖数据，无法被trace记录，导出时统一用稠密knn（结果相同）
+config = model_config(num_points=args.num_points, featnet=args.featnet, emb_dims=args.emb_dims,
+                      fstn=args.fstn, xyzstn=args.xyzstn, spatial_knn="dense", vlad_rank=args.vlad_rank)
+model = load_checkpoint(args.pretrained_path, config)
+export(model, config, args.torchscript, args.onnx, batch_size=args.batch_size, opset_version=args.opset)
+for path in (args.torchscript, args.onnx):
+    if path:
+        print("exported " + path)
@@ -1,3 +1,4 @@
 python generate_test_sets.py
 python generate_training_tuples_baseline.py
-python generate_training_tuples_refine.py
\ No newline at end of file
+python generate_training_tuples_refine.py
+python generate_pc_store.py
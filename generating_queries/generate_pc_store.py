@@ -0,0 +1,50 @@
+import argparse
+import glob
+import os
+import pickle
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, "..")))
+import config as cfg
+from util.pc_store import build_store
+from util.query_index import QueryIndex
+
+
+def files_in_pickle(filename):
+    # 训练元组是npz，评估pickle是[{key:{'query':file}}, ...]
+    if filename.endswith('.npz'):
+        return [str(f) for f in QueryIndex.load(filename).files]
+    with open(filename, 'rb') as handle:
+        queries = pickle.load(handle)
+    if isinstance(queries, dict):
+        queries = [queries]
+    files = []
+    for trajectory in queries:
+        for key in range(len(trajectory.keys())):
+            files.append(trajectory[key]["query"])
+    return files
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset_folder', default=cfg.DATASET_FOLDER,
+                    help='PointNetVlad Dataset Folder')
+parser.add_argument('--output', default='',
+                    help='Store folder [default: <dataset_folder>/pc_store]')
+parser.add_argument('--pickles', nargs='*', default=[],
+                    help='Only pack the submaps referenced by these pickles/npz [default: every .bin]')
+args = parser.parse_args()
+
+if args.output == '':
+    args.output = os.path.join(args.dataset_folder, 'pc_store')
+
+filenames = []
+if len(args.pickles) == 0:
+    for path in sorted(glob.glob(os.path.join(args.dataset_folder, '**', '*.bin'), recursive=True)):
+        filenames.append(os.path.relpath(path, args.dataset_folder))
+else:
+    for pickle_file in args.pickles:
+        filenames.extend(files_in_pickle(pickle_file))
+print("Number of submaps: " + str(len(filenames)))
+
+build_store(args.dataset_folder, filenames, args.output)
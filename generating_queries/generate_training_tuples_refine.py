@@ -1,8 +1,5 @@
 import os
-import pickle
-import random
 
-import numpy as np
 import pandas as pd
 from sklearn.neighbors import KDTree
 import sys
@@ -10,6 +7,7 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(BASE_DIR)
 sys.path.append(os.path.abspath(os.path.join(BASE_DIR, "..")))
 import config as cfg
+from util.query_index import QueryIndex
 
 #####For training and test data split#####
 x_width = 150
@@ -49,22 +47,10 @@ def construct_query_dict(df_centroids, filename):
     tree = KDTree(df_centroids[['northing','easting']])
     ind_nn = tree.query_radius(df_centroids[['northing','easting']],r=12.5)
     ind_r = tree.query_radius(df_centroids[['northing','easting']], r=50)
-    queries = {}
     print(len(ind_nn))
-    for i in range(len(ind_nn)):
-        query = df_centroids.iloc[i]["file"]
-        positives = np.setdiff1d(ind_nn[i],[i]).tolist()
-        list_neg = np.setdiff1d(df_centroids.index.values.tolist(),ind_r[i]).tolist()
-        # if len(list_neg) > 4001:
-        #     random.shuffle(list_neg)
-        #     list_neg = list_neg[:4001]
-        negatives = list_neg
-        random.shuffle(negatives)
-        queries[i] = {"query":query,
-                      "positives":positives,"negatives":negatives}
-
-    with open(filename, 'wb') as handle:
-        pickle.dump(queries, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # 只保存正样本和50m以内邻居的CSR数组，50m以外的都是负样本，训练时再采样
+    queries = QueryIndex.from_radius(df_centroids["file"].values, ind_nn, ind_r)
+    queries.save(filename)
 
     print("Done ", filename)
 
@@ -128,4 +114,4 @@ for folder in folders:
             df_train = df_train.append(row, ignore_index=True)
 
 print("Number of training submaps: "+str(len(df_train['file'])))
-construct_query_dict(df_train,"copy/"+"training_queries_refine.pickle")
+construct_query_dict(df_train,"copy/"+"training_queries_refine.npz")
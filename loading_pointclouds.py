@@ -3,10 +3,23 @@
 import os
 import pickle
 import numpy as np
-import random
 import config as cfg
-from time import time
 from util.initPara import log_string
+from util.pc_store import PointCloudStore
+from util.query_index import QueryIndex
+
+PC_STORE = None
+
+
+def get_pc_store():
+    # 打开一次，之后fork出的worker共享同一份mmap
+    global PC_STORE
+    if PC_STORE is None and cfg.PC_STORE_FOLDER:
+        PC_STORE = PointCloudStore(cfg.PC_STORE_FOLDER)
+        log_string("use pc store " + cfg.PC_STORE_FOLDER + " " + str(len(PC_STORE)))
+    return PC_STORE
+
+
 def get_queries_dict(filename):
     # key:{'query':file,'positives':[files],'negatives:[files], 'neighbors':[keys]}
     with open(filename, 'rb') as handle:
@@ -15,6 +28,20 @@ def get_queries_dict(filename):
         return queries
 
 
+def get_queries_index(filename):
+    # .npz: {files, pos_ptr, pos_idx, nbr_ptr, nbr_idx}，负样本为50m邻居以外的所有子图
+    if not os.path.exists(filename):
+        # 旧版本的pickle，转换一次并保存成npz，下次直接读取
+        legacy = os.path.splitext(filename)[0] + ".pickle"
+        queries = QueryIndex.from_queries_dict(get_queries_dict(legacy))
+        queries.save(filename)
+        log_string("convert " + legacy + " to " + filename)
+        return queries
+    queries = QueryIndex.load(filename)
+    print("Queries Loaded.")
+    return queries
+
+
 def get_sets_dict(filename):
     #[key_dataset:{key_pointcloud:{'query':file,'northing':value,'easting':value}},key_dataset:{key_pointcloud:{'query':file,'northing':value,'easting':value}}, ...}
     with open(filename, 'rb') as handle:
@@ -25,6 +52,12 @@ def get_sets_dict(filename):
 
 def load_pc_file(filename):
     # returns Nx3 matrix
+    store = get_pc_store()
+    if store is not None:
+        pc = store.get(filename)
+        if pc is not None:
+            return pc
+
     pc = np.fromfile(os.path.join(cfg.DATASET_FOLDER, filename), dtype=np.float64)
 
     if(pc.shape[0] != 4096*3):
@@ -36,6 +69,12 @@ def load_pc_file(filename):
 
 
 def load_pc_files(filenames):
+    store = get_pc_store()
+    if store is not None:
+        pcs = store.get_many(filenames)
+        if pcs is not None:
+            return pcs
+
     pcs = []
     for filename in filenames:
         # log_string(filename)
@@ -83,181 +122,3 @@ def jitter_point_cloud(batch_data, sigma=0.005, clip=0.05):
     jittered_data = np.clip(sigma * np.random.randn(B, N, C), -1*clip, clip)
     jittered_data += batch_data
     return jittered_data
-
-
-def get_query_tuple(dict_value, num_pos, num_neg, QUERY_DICT, hard_neg=[], other_neg=False):
-    # get query tuple for dictionary entry
-    # return list [query,positives,negatives]
-    start = time()
-    query = load_pc_file(dict_value["query"])  # Nx3
-    random.shuffle(dict_value["positives"])
-    pos_files = []
-
-    # 不必考虑正样本是否充足，因为之前判断过
-    for i in range(num_pos):
-        pos_files.append(QUERY_DICT[dict_value["positives"][i]]["query"])
-    positives = load_pc_files(pos_files)
-
-    neg_files = []
-    neg_indices = []
-    if(len(hard_neg) == 0):
-        random.shuffle(dict_value["negatives"])
-        for i in range(num_neg):
-            neg_files.append(QUERY_DICT[dict_value["negatives"][i]]["query"])
-            neg_indices.append(dict_value["negatives"][i])
-    else:
-        random.shuffle(dict_value["negatives"])
-        for i in hard_neg:
-            neg_files.append(QUERY_DICT[i]["query"])
-            neg_indices.append(i)
-        j = 0
-        # 如果hard不够，再进行补充
-        while(len(neg_files) < num_neg):
-            if not dict_value["negatives"][j] in hard_neg:
-                neg_files.append(
-                    QUERY_DICT[dict_value["negatives"][j]]["query"])
-                neg_indices.append(dict_value["negatives"][j])
-            j += 1
-    negatives = load_pc_files(neg_files)
-
-    # log_string("load time: ",time()-start)
-    # 是否需要额外的neg（Quadruplet loss需要）
-    if other_neg is False:
-        return [query, positives, negatives]
-    else:
-        # get neighbors of negatives and query
-        neighbors = []
-        for pos in dict_value["positives"]:
-            neighbors.append(pos)
-        for neg in neg_indices:
-            for pos in QUERY_DICT[neg]["positives"]:
-                neighbors.append(pos)
-        # 减去与neighbors公共有的部分，剩下既不进也不远的那些部分
-        possible_negs = list(set(QUERY_DICT.keys())-set(neighbors))
-        random.shuffle(possible_negs)
-        if(len(possible_negs) == 0):
-            return [query, positives, negatives, np.array([])]
-        neg2 = load_pc_file(QUERY_DICT[possible_negs[0]]["query"]) # 就一个
-
-        return [query, positives, negatives, neg2]
-
-
-def get_rotated_tuple(dict_value, num_pos, num_neg, QUERY_DICT, hard_neg=[], other_neg=False):
-    query = load_pc_file(dict_value["query"])  # Nx3
-    q_rot = rotate_point_cloud(np.expand_dims(query, axis=0))
-    q_rot = np.squeeze(q_rot)
-
-    random.shuffle(dict_value["positives"])
-    pos_files = []
-    for i in range(num_pos):
-        pos_files.append(QUERY_DICT[dict_value["positives"][i]]["query"])
-    #positives= load_pc_files(dict_value["positives"][0:num_pos])
-    positives = load_pc_files(pos_files)
-    p_rot = rotate_point_cloud(positives)
-
-    neg_files = []
-    neg_indices = []
-    if(len(hard_neg) == 0):
-        random.shuffle(dict_value["negatives"])
-        for i in range(num_neg):
-            neg_files.append(QUERY_DICT[dict_value["negatives"][i]]["query"])
-            neg_indices.append(dict_value["negatives"][i])
-    else:
-        random.shuffle(dict_value["negatives"])
-        for i in hard_neg:
-            neg_files.append(QUERY_DICT[i]["query"])
-            neg_indices.append(i)
-        j = 0
-        while(len(neg_files) < num_neg):
-            if not dict_value["negatives"][j] in hard_neg:
-                neg_files.append(
-                    QUERY_DICT[dict_value["negatives"][j]]["query"])
-                neg_indices.append(dict_value["negatives"][j])
-            j += 1
-    negatives = load_pc_files(neg_files)
-    n_rot = rotate_point_cloud(negatives)
-
-    if other_neg is False:
-        return [q_rot, p_rot, n_rot]
-
-    # For Quadruplet Loss
-    else:
-        # get neighbors of negatives and query
-        neighbors = []
-        for pos in dict_value["positives"]:
-            neighbors.append(pos)
-        for neg in neg_indices:
-            for pos in QUERY_DICT[neg]["positives"]:
-                neighbors.append(pos)
-        possible_negs = list(set(QUERY_DICT.keys())-set(neighbors))
-        random.shuffle(possible_negs)
-
-        if(len(possible_negs) == 0):
-            return [q_jit, p_jit, n_jit, np.array([])]
-
-        neg2 = load_pc_file(QUERY_DICT[possible_negs[0]]["query"])
-        n2_rot = rotate_point_cloud(np.expand_dims(neg2, axis=0))
-        n2_rot = np.squeeze(n2_rot)
-
-        return [q_rot, p_rot, n_rot, n2_rot]
-
-
-def get_jittered_tuple(dict_value, num_pos, num_neg, QUERY_DICT, hard_neg=[], other_neg=False):
-    query = load_pc_file(dict_value["query"])  # Nx3
-    #q_rot= rotate_point_cloud(np.expand_dims(query, axis=0))
-    q_jit = jitter_point_cloud(np.expand_dims(query, axis=0))
-    q_jit = np.squeeze(q_jit)
-
-    random.shuffle(dict_value["positives"])
-    pos_files = []
-    for i in range(num_pos):
-        pos_files.append(QUERY_DICT[dict_value["positives"][i]]["query"])
-    #positives= load_pc_files(dict_value["positives"][0:num_pos])
-    positives = load_pc_files(pos_files)
-    p_jit = jitter_point_cloud(positives)
-
-    neg_files = []
-    neg_indices = []
-    if(len(hard_neg) == 0):
-        random.shuffle(dict_value["negatives"])
-        for i in range(num_neg):
-            neg_files.append(QUERY_DICT[dict_value["negatives"][i]]["query"])
-            neg_indices.append(dict_value["negatives"][i])
-    else:
-        random.shuffle(dict_value["negatives"])
-        for i in hard_neg:
-            neg_files.append(QUERY_DICT[i]["query"])
-            neg_indices.append(i)
-        j = 0
-        while(len(neg_files) < num_neg):
-            if not dict_value["negatives"][j] in hard_neg:
-                neg_files.append(
-                    QUERY_DICT[dict_value["negatives"][j]]["query"])
-                neg_indices.append(dict_value["negatives"][j])
-            j += 1
-    negatives = load_pc_files(neg_files)
-    n_jit = jitter_point_cloud(negatives)
-
-    if other_neg is False:
-        return [q_jit, p_jit, n_jit]
-
-    # For Quadruplet Loss
-    else:
-        # get neighbors of negatives and query
-        neighbors = []
-        for pos in dict_value["positives"]:
-            neighbors.append(pos)
-        for neg in neg_indices:
-            for pos in QUERY_DICT[neg]["positives"]:
-                neighbors.append(pos)
-        possible_negs = list(set(QUERY_DICT.keys())-set(neighbors))
-        random.shuffle(possible_negs)
-
-        if(len(possible_negs) == 0):
-            return [q_jit, p_jit, n_jit, np.array([])]
-
-        neg2 = load_pc_file(QUERY_DICT[possible_negs[0]]["query"])
-        n2_jit = jitter_point_cloud(np.expand_dims(neg2, axis=0))
-        n2_jit = np.squeeze(n2_jit)
-
-        return [q_jit, p_jit, n_jit, n2_jit]
@@ -3,43 +3,48 @@ import math
 import torch
 
 
+def squared_distance(a, b):
+    # 广播计算最后一维上的平方距离，不再repeat出query的副本
+    return ((a - b) ** 2).sum(-1)
+
+
 def best_pos_distance(query, pos_vecs):
-    num_pos = pos_vecs.shape[1]
-    query_copies = query.repeat(1, int(num_pos), 1)
-    diff = ((pos_vecs - query_copies) ** 2).sum(2)
+    diff = squared_distance(query, pos_vecs)  # [B,num_pos]
     min_pos, _ = diff.min(1)
     max_pos, _ = diff.max(1)
     return min_pos, max_pos
 
 
-def triplet_loss(q_vec, pos_vecs, neg_vecs, margin, use_min=False, lazy=False, ignore_zero_loss=False):
+def hinge_losses(q_vec, pos_vecs, neg_vecs, anchors, margins, use_min=False, lazy=False, ignore_zero_loss=False):
+    # 每个anchor一项hinge loss：margins[t] + positive - |neg_vecs - anchors[:, t]|^2，各自归约成标量
+    # anchors [B,T,D]为query（四元组loss的第二项为other_neg），所有anchor到所有负样本的距离一次广播计算 [B,T,num_neg]，返回T个loss
     min_pos, max_pos = best_pos_distance(q_vec, pos_vecs)
 
     # PointNetVLAD official code use min_pos, but i think max_pos should be used
-    if use_min:
+    if use_min:#获得正样本最小的距离还是最大
         positive = min_pos
     else:
         positive = max_pos
 
-    num_neg = neg_vecs.shape[1]
-    batch = q_vec.shape[0]
-    query_copies = q_vec.repeat(1, int(num_neg), 1)
-    positive = positive.view(-1, 1)
-    positive = positive.repeat(1, int(num_neg))
-
-    loss = margin + positive - ((neg_vecs - query_copies) ** 2).sum(2)
+    negative = squared_distance(anchors.unsqueeze(2), neg_vecs.unsqueeze(1))  # [B,T,num_neg]
+    margins = torch.tensor(margins, dtype=negative.dtype, device=negative.device).view(1, -1, 1)
+    loss = margins + positive.view(-1, 1, 1) - negative
     loss = loss.clamp(min=0.0)
+    # 是否只看max
     if lazy:
-        triplet_loss = loss.max(1)[0]
+        loss = loss.max(2)[0]  # [B,T]
     else:
-        triplet_loss = loss.sum(1)
+        loss = loss.sum(2)
+    # 是否忽略为0的loss
     if ignore_zero_loss:
-        hard_triplets = torch.gt(triplet_loss, 1e-16).float()
-        num_hard_triplets = torch.sum(hard_triplets)
-        triplet_loss = triplet_loss.sum() / (num_hard_triplets + 1e-16)
-    else:
-        triplet_loss = triplet_loss.mean()
-    return triplet_loss
+        # gt 若大于1e-16则为1
+        num_hard = torch.gt(loss, 1e-16).float().sum(0)
+        return loss.sum(0) / (num_hard + 1e-16)
+    return loss.mean(0)
+
+
+def triplet_loss(q_vec, pos_vecs, neg_vecs, margin, use_min=False, lazy=False, ignore_zero_loss=False):
+    return hinge_losses(q_vec, pos_vecs, neg_vecs, q_vec, [margin], use_min, lazy, ignore_zero_loss)[0]
 
 
 def triplet_loss_wrapper(q_vec, pos_vecs, neg_vecs, other_neg, m1, m2, use_min=False, lazy=False, ignore_zero_loss=False):
@@ -47,51 +52,54 @@ def triplet_loss_wrapper(q_vec, pos_vecs, neg_vecs, other_neg, m1, m2, use_min=F
 
 
 def quadruplet_loss(q_vec, pos_vecs, neg_vecs, other_neg, m1, m2, use_min=False, lazy=False, ignore_zero_loss=False):
-    min_pos, max_pos = best_pos_distance(q_vec, pos_vecs)
+    # 第一项为query与负样本，第二项为other_neg与负样本
+    anchors = torch.cat((q_vec, other_neg), dim=1)  # [B,2,D]
+    triplet_loss, second_loss = hinge_losses(q_vec, pos_vecs, neg_vecs, anchors, [m1, m2],
+                                             use_min, lazy, ignore_zero_loss)
+    total_loss = triplet_loss + second_loss
+    return total_loss
 
-    # PointNetVLAD official code use min_pos, but i think max_pos should be used
-    if use_min:#获得正样本最小的距离还是最大
+
+def in_batch_distances(q_vec, pos_vecs, neg_vecs, other_neg, neg_mask, use_min=False):
+    # 每个query到整个batch所有描述子的距离 [B, B*tuple_size]，列的顺序与dataset给出的neg_mask一致
+    min_pos, max_pos = best_pos_distance(q_vec, pos_vecs)
+    if use_min:
         positive = min_pos
     else:
         positive = max_pos
+    embeddings = torch.cat((q_vec, pos_vecs, neg_vecs, other_neg), dim=1)
+    embeddings = embeddings.view(1, -1, embeddings.shape[-1])  # [1,B*tuple_size,D]
+    negative = squared_distance(q_vec, embeddings)
+    return positive, negative, neg_mask.bool()
 
-    num_neg = neg_vecs.shape[1]
-    batch = q_vec.shape[0]
-    query_copies = q_vec.repeat(1, int(num_neg), 1)
-    positive = positive.view(-1, 1)
-    positive = positive.repeat(1, int(num_neg))
 
-    loss = m1 + positive - ((neg_vecs - query_copies) ** 2).sum(2)
-    loss = loss.clamp(min=0.0)
-    # 是否只看max
-    if lazy:
-        triplet_loss = loss.max(1)[0]
-    else:
-        triplet_loss = loss.sum(1)
-    # 是否忽略为0的loss
+def reduce_hinge(loss, ignore_zero_loss=False):
     if ignore_zero_loss:
-        # gt 若大于1e-16则为1
-        hard_triplets = torch.gt(triplet_loss, 1e-16).float()
-        num_hard_triplets = torch.sum(hard_triplets)
-        triplet_loss = triplet_loss.sum() / (num_hard_triplets + 1e-16)
-    else:
-        triplet_loss = triplet_loss.mean()
-
-    other_neg_copies = other_neg.repeat(1, int(num_neg), 1)
-    second_loss = m2 + positive - ((neg_vecs - other_neg_copies) ** 2).sum(2)
-    second_loss = second_loss.clamp(min=0.0)
-    if lazy:
-        second_loss = second_loss.max(1)[0]
-    else:
-        second_loss = second_loss.sum(1)
-    # 是否忽略为0的loss
-    if ignore_zero_loss:
-        # gt 若大于1e-16则为1
-        hard_second = torch.gt(second_loss, 1e-16).float()
-        num_hard_second = torch.sum(hard_second)
-        second_loss = second_loss.sum() / (num_hard_second + 1e-16)
-    else:
-        second_loss = second_loss.mean()
-
-    total_loss = triplet_loss + second_loss
-    return total_loss
+        hard = torch.gt(loss, 1e-16).float()
+        return loss.sum() / (torch.sum(hard) + 1e-16)
+    return loss.mean()
+
+
+def in_batch_hard_loss(q_vec, pos_vecs, neg_vecs, other_neg, m1, m2, use_min=False, lazy=False,
+                       ignore_zero_loss=False, neg_mask=None):
+    # 与batch内所有描述子中最难的负样本计算triplet loss
+    # neg_mask [B, B*tuple_size]标出每个query邻域以外的子图，其他tuple的query、正样本和负样本也都是负样本；不使用m2和lazy
+    positive, negative, neg_mask = in_batch_distances(q_vec, pos_vecs, neg_vecs, other_neg, neg_mask, use_min)
+    hardest = negative.masked_fill(~neg_mask, float('inf')).min(1)[0]
+    loss = (m1 + positive - hardest).clamp(min=0.0)
+    return reduce_hinge(loss, ignore_zero_loss)
+
+
+def in_batch_weighted_loss(q_vec, pos_vecs, neg_vecs, other_neg, m1, m2, use_min=False, lazy=False,
+                           ignore_zero_loss=False, neg_mask=None):
+    # 对batch内所有负样本计算triplet loss，按距离加权，越近权重越大
+    # 权重为每个query的负样本上的softmax(-d / mean(d))，不参与求导；相当于按距离递减的概率为每个query抽一个负样本时loss的期望
+    positive, negative, neg_mask = in_batch_distances(q_vec, pos_vecs, neg_vecs, other_neg, neg_mask, use_min)
+    with torch.no_grad():
+        scale = (negative * neg_mask).sum(1, keepdim=True) / neg_mask.sum(1, keepdim=True).clamp(min=1)
+        weights = torch.softmax(-negative.masked_fill(~neg_mask, float('inf')) / scale.clamp(min=1e-12), dim=1)
+        # 没有负样本的行softmax为nan，权重置0
+        weights = weights.masked_fill(~neg_mask, 0.0)
+    loss = (m1 + positive.view(-1, 1) - negative).clamp(min=0.0)
+    loss = (weights * loss).sum(1)
+    return reduce_hinge(loss, ignore_zero_loss)
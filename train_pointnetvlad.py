@@ -11,9 +11,11 @@ from torch.backends import cudnn
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 import util.initPara as para
-from util.initPara import print_gpu,log_string, BASE_LEARNING_RATE
+from util.initPara import print_gpu,log_string, peak_memory, BASE_LEARNING_RATE
 from torch.optim.lr_scheduler import ReduceLROnPlateau, StepLR, MultiStepLR
-from util.data import TRAINING_QUERIES, device, update_vectors, Oxford_train_advance, Oxford_train_base
+from util.data import TRAINING_QUERIES, device, update_vectors, refresh_vectors, write_latents, latent_ages, Oxford_train_advance, Oxford_train_base, get_loader
+from util.amp import AMP_DTYPES, grad_scaler, benchmark
+from util.distributed import is_main_process, broadcast_object, get_world_size, unwrap, NullWriter
 import util.data as datapy
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -44,6 +46,13 @@ def train():
         # 有了第二项约束，类内间距离应该比内类距离大
         log_string("use quadruplet_loss")
         loss_function = PNV_loss.quadruplet_loss
+    elif para.args.loss_function == 'in_batch_hard':
+        # batch内其他tuple的所有子图也作为负样本
+        log_string("use in_batch_hard_loss")
+        loss_function = PNV_loss.in_batch_hard_loss
+    elif para.args.loss_function == 'in_batch_weighted':
+        log_string("use in_batch_weighted_loss")
+        loss_function = PNV_loss.in_batch_weighted_loss
     else:
         log_string("use triplet_loss_wrapper")
         loss_function = PNV_loss.triplet_loss_wrapper
@@ -66,9 +75,10 @@ def train():
     else:
         if para.args.pretrained_path[-1]=="7":
             log_string("load pretrained model" + para.args.pretrained_path)
-            para.model.load_state_dict(torch.load(para.args.pretrained_path), strict=False)
+            para.model.load_state_dict(torch.load(para.args.pretrained_path, map_location=device), strict=False)
         else:
-            checkpoint = torch.load(para.args.pretrained_path)
+            # 每个rank读到自己的卡上
+            checkpoint = torch.load(para.args.pretrained_path, map_location=device)
             saved_state_dict = checkpoint['state_dict']
             starting_epoch = checkpoint['epoch'] + 1
             TOTAL_ITERATIONS = checkpoint['iter']
@@ -76,16 +86,24 @@ def train():
             optimizer.load_state_dict(checkpoint['optimizer'])
             log_string("load checkpoint" + para.args.pretrained_path+ " starting_epoch: "+ str(starting_epoch))
 
-    if torch.cuda.device_count() > 1:
+    if para.args.distributed:
+        # 每个进程一张卡（或cpu上一个进程），只同步梯度；不用--fstn/--xyzstn时stn的参数不参与计算
+        para.model = nn.parallel.DistributedDataParallel(
+            para.model, device_ids=[para.args.local_rank] if device.type == "cuda" else None,
+            find_unused_parameters=True)
+        log_string("DistributedDataParallel on " + str(get_world_size()) + " processes")
+    elif torch.cuda.device_count() > 1:
         para.model = nn.parallel.DataParallel(para.model)
         log_string("Let's use "+ str(torch.cuda.device_count())+ " GPUs!")
 
-    loader_base = DataLoader(Oxford_train_base(args=para.args),batch_size=para.args.batch_num_queries, shuffle=False, drop_last=True, num_workers=4)
-    loader_advance = DataLoader(Oxford_train_advance(args=para.args),batch_size=para.args.batch_num_queries, shuffle=False, drop_last=True, num_workers=4)
+    loader_base = get_loader(Oxford_train_base(args=para.args), para.args.batch_num_queries)
+    loader_advance = get_loader(Oxford_train_advance(args=para.args), para.args.batch_num_queries)
 
     if starting_epoch > division_epoch + 1:
-        update_vectors(para.args, para.model)
-    train_writer = SummaryWriter(os.path.join(para.args.log_dir, 'train_writer'))
+        update_vectors(para.args, para.model, iteration=TOTAL_ITERATIONS)
+    # fp16时动态调整loss的缩放倍数，bf16/fp32时不做任何事
+    scaler = grad_scaler(AMP_DTYPES[para.args.amp], device)
+    train_writer = SummaryWriter(os.path.join(para.args.log_dir, 'train_writer')) if is_main_process() else NullWriter()
     # print_gpu("1")
     # scheduler = StepLR(optimizer, step_size=5, gamma=0.5)
     # recall 停止上升时
@@ -102,32 +120,38 @@ def train():
         # lr_temp = get_learning_rate(epoch)
         # for param_group in optimizer.param_groups:
         #     param_group["lr"] = lr_temp
-        train_one_epoch(optimizer, train_writer, loss_function, epoch, loader_base, loader_advance, ave_one_percent_recall)
+        train_one_epoch(optimizer, scaler, train_writer, loss_function, epoch, loader_base, loader_advance, ave_one_percent_recall)
         log_string("learn rate " + str(optimizer.param_groups[0]['lr']))
+        peak, scope = peak_memory()
+        log_string("peak memory (%s) %.1f MB" % (scope, peak))
         log_string('EVALUATING...')
         cfg.OUTPUT_FILE = cfg.RESULTS_FOLDER + 'results_' + str(epoch) + '.txt'
-        ave_recall, average_similarity_score, ave_one_percent_recall = evaluate.evaluate_model(para.model, tqdm_flag=True)
-        log_string('EVAL %% RECALL: %s' % str(ave_one_percent_recall))
-
-        save_model(epoch, optimizer, ave_one_percent_recall)
+        # 只在rank 0上评估和保存，recall广播给其他rank，保证各rank的学习率调整一致
+        if is_main_process():
+            ave_recall, average_similarity_score, ave_one_percent_recall = evaluate.evaluate_model(
+                unwrap(para.model), tqdm_flag=True)
+            log_string('EVAL %% RECALL: %s' % str(ave_one_percent_recall))
+            save_model(epoch, optimizer, ave_one_percent_recall)
+        ave_one_percent_recall = broadcast_object(ave_one_percent_recall)
         # scheduler.step()
         scheduler.step(ave_one_percent_recall)
         train_writer.add_scalar("Val Recall", ave_one_percent_recall, epoch)
 
-def train_one_epoch(optimizer, train_writer, loss_function, epoch, loader_base, loader_advance, ave_one_percent_recall):
+def train_one_epoch(optimizer, scaler, train_writer, loss_function, epoch, loader_base, loader_advance, ave_one_percent_recall):
     global TOTAL_ITERATIONS
     batch_num = para.args.batch_num_queries
     if epoch <= division_epoch:
-        for queries, positives, negatives, other_neg in tqdm(loader_base):
+        for tuples in tqdm(loader_base, disable=not is_main_process()):
             para.model.train()
             optimizer.zero_grad()
             output_queries, output_positives, output_negatives, output_other_neg = run_model(
-                para.model, queries, positives, negatives, other_neg)
+                para.model, *tuples[:4])
             loss = loss_function(output_queries, output_positives, output_negatives, output_other_neg, para.args.margin_1,
                                  para.args.margin_2, use_min=para.args.triplet_use_best_positives, lazy=para.args.loss_lazy,
-                                 ignore_zero_loss=para.args.loss_ignore_zero_batch)
-            loss.backward()
-            optimizer.step()
+                                 ignore_zero_loss=para.args.loss_ignore_zero_batch, **loss_kwargs(tuples))
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             train_writer.add_scalar("epoch", epoch, TOTAL_ITERATIONS)
             train_writer.add_scalar("Loss", loss.cpu().item(), TOTAL_ITERATIONS)
             train_writer.add_scalar("learn rate", optimizer.param_groups[0]['lr'], TOTAL_ITERATIONS)
@@ -141,41 +165,64 @@ def train_one_epoch(optimizer, train_writer, loss_function, epoch, loader_base,
 
     else:
         if epoch == division_epoch + 1:
-            update_vectors(para.args, para.model)
-        for queries, positives, negatives, other_neg in tqdm(loader_advance):
+            update_vectors(para.args, para.model, iteration=TOTAL_ITERATIONS)
+        for tuples in tqdm(loader_advance, disable=not is_main_process()):
             from time import time
             start = time()
             para.model.train()
             optimizer.zero_grad()
             output_queries, output_positives, output_negatives, output_other_neg = run_model(
-                para.model, queries, positives, negatives, other_neg)
+                para.model, *tuples[:4])
             # log_string("train: ",time()-start)
             loss = loss_function(output_queries, output_positives, output_negatives, output_other_neg, para.args.margin_1,
                                  para.args.margin_2, use_min=para.args.triplet_use_best_positives, lazy=para.args.loss_lazy,
-                                 ignore_zero_loss=para.args.loss_ignore_zero_batch)
+                                 ignore_zero_loss=para.args.loss_ignore_zero_batch, **loss_kwargs(tuples))
             # log_string("train: ",time()-start)
             # 比较耗时
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            if para.args.latent_writeback:
+                # 这一步已经算出的描述子直接写回缓存
+                write_latents(tuples[4], torch.cat((output_queries, output_positives, output_negatives,
+                                                    output_other_neg), 1), TOTAL_ITERATIONS)
             train_writer.add_scalar("epoch", epoch, TOTAL_ITERATIONS)
             train_writer.add_scalar("Loss", loss.cpu().item(), TOTAL_ITERATIONS)
             train_writer.add_scalar("learn rate", optimizer.param_groups[0]['lr'], TOTAL_ITERATIONS)
             TOTAL_ITERATIONS += para.args.batch_num_queries
             # log_string("train: ",time()-start)
-            if (TOTAL_ITERATIONS % (int(700 * (epoch + 1))//batch_num*batch_num) ==0):
-                update_vectors(para.args, para.model, tqdm_flag=False)
+            if para.args.latent_refresh > 0:
+                # 每一步滚动刷新一部分描述子，不再整体暂停
+                refresh_vectors(para.args, para.model, TOTAL_ITERATIONS)
+            elif (TOTAL_ITERATIONS % (int(700 * (epoch + 1))//batch_num*batch_num) ==0):
+                update_vectors(para.args, para.model, tqdm_flag=False, iteration=TOTAL_ITERATIONS,
+                               max_age=latent_max_age(int(700 * (epoch + 1))//batch_num*batch_num))
+            if (para.args.latent_refresh > 0 or para.args.latent_writeback) and \
+                    TOTAL_ITERATIONS % (100 * batch_num) == 0:
+                ages = latent_ages(TOTAL_ITERATIONS)
+                train_writer.add_histogram("latent age", ages, TOTAL_ITERATIONS)
+                train_writer.add_scalar("latent age max", ages.max(), TOTAL_ITERATIONS)
             # if (TOTAL_ITERATIONS % (int(1000 * (epoch + 1)) // batch_num * batch_num) == 0):
             #     ave_recall, average_similarity_score, ave_one_percent_recall = evaluate.evaluate_model(para.model, tqdm_flag=False)
             #     log_string('EVAL %% RECALL: %s' % str(ave_one_percent_recall), print_flag=True)
             #     train_writer.add_scalar("one percent recall", ave_one_percent_recall, TOTAL_ITERATIONS)
 
+def latent_max_age(interval):
+    # 写回时默认跳过上次定期刷新以来写回过的描述子，否则全部重新计算
+    if para.args.latent_max_age >= 0:
+        return para.args.latent_max_age
+    return interval if para.args.latent_writeback else 0
+
+def loss_kwargs(tuples):
+    # tuple和序号之后，in-batch loss时dataset多给出负样本mask [B, B*tuple_size]
+    if len(tuples) > 5:
+        return {"neg_mask": tuples[5].to(device)}
+    return {}
+
 def save_model(epoch, optimizer, ave_one_percent_recall):
     global best_ave_one_percent_recall
-    if isinstance(para.model, nn.DataParallel):
-        model_to_save = para.model.module
-    else:
-        model_to_save = para.model
-        
+    model_to_save = unwrap(para.model)
+
     save_name = para.args.model_save_path + '/' + str(epoch) + "-" + cfg.MODEL_FILENAME
     torch.save({
         'epoch': epoch,
@@ -204,7 +251,7 @@ def run_model(model, queries, positives, negatives, other_neg, require_grad=True
     feed_tensor = torch.cat((queries, positives, negatives, other_neg), 1)
     feed_tensor = feed_tensor.view((-1, 1, para.args.num_points, 3))
     # feed_tensor.requires_grad_(require_grad)
-    feed_tensor = feed_tensor.cuda()
+    feed_tensor = feed_tensor.to(device)
     # print_gpu("3")
     if require_grad:
         output = model(feed_tensor)
@@ -216,17 +263,34 @@ def run_model(model, queries, positives, negatives, other_neg, require_grad=True
         output, [1, para.args.positives_per_query, para.args.negatives_per_query, 1], dim=1)
     return o1, o2, o3, o4
 
+def amp_benchmark():
+    # 用一个训练batch大小的随机输入比较--amp与fp32的激活显存/内存和吞吐
+    tuple_size = 1 + para.args.positives_per_query + para.args.negatives_per_query + 1
+    feed_tensor = torch.rand(para.args.batch_num_queries * tuple_size, 1, para.args.num_points, 3, device=device)
+    model = getattr(para.model, "module", para.model)
+    fp32_bytes, fp32_speed = benchmark(model, feed_tensor, None)
+    amp_bytes, amp_speed = benchmark(model, feed_tensor, AMP_DTYPES[para.args.amp])
+    log_string("fp32 activations: %.1f MB, %.2f clouds/s" % (fp32_bytes / 1024 ** 2, fp32_speed))
+    log_string("%s activations: %.1f MB, %.2f clouds/s" % (para.args.amp, amp_bytes / 1024 ** 2, amp_speed))
+    log_string("memory x%.2f, throughput x%.2f" % (amp_bytes / max(fp32_bytes, 1), amp_speed / fp32_speed))
+
+
 if __name__ == "__main__":
-    if para.args.eval:
+    if para.args.amp_benchmark:
+        amp_benchmark()
+    elif para.args.eval and not is_main_process():
+        # 多进程启动时只由rank 0评估
+        pass
+    elif para.args.eval:
         log_string("start eval!")
         if not os.path.exists(para.args.pretrained_path):
             log_string("can't find pretrained model" + para.args.pretrained_path)
         else:
             if para.args.pretrained_path[-1] == "7":
                 log_string("load pretrained model" + para.args.pretrained_path)
-                para.model.load_state_dict(torch.load(para.args.pretrained_path), strict=True)
+                para.model.load_state_dict(torch.load(para.args.pretrained_path, map_location=device), strict=True)
             else:
-                checkpoint = torch.load(para.args.pretrained_path)
+                checkpoint = torch.load(para.args.pretrained_path, map_location=device)
                 saved_state_dict = checkpoint['state_dict']
                 starting_epoch = checkpoint['epoch'] + 1
                 TOTAL_ITERATIONS = checkpoint['iter']
@@ -242,9 +306,23 @@ if __name__ == "__main__":
         #     if name=='module.point_net.stn.fc2.bias':
         #         print(param)
 
-        ave_recall, average_similarity_score, ave_one_percent_recall = evaluate.evaluate_model(para.model, tqdm_flag=True)
+        if para.args.quantize:
+            # 从训练子图中随机抽取校准样本，--eval时data.py不加载训练集，这里单独读取索引
+            train_queries = get_queries_index(cfg.TRAIN_FILE_EASY)
+            num_calib = min(para.args.quant_calib, len(train_queries))
+            if num_calib <= 0:
+                raise ValueError("--quant_calib selects no calibration clouds from " + cfg.TRAIN_FILE_EASY)
+            calib = np.random.choice(len(train_queries), num_calib, replace=False)
+            calib_clouds = load_pc_files(list(train_queries.files[np.sort(calib)]))
+            para.model = evaluate.evaluate_quantized(para.model, calib_clouds, para.args.quant_tol, tqdm_flag=True)
+        elif len(para.args.eval_benchmarks) > 0:
+            results = evaluate.evaluate_benchmarks(para.model, para.args.eval_benchmarks, tqdm_flag=True)
+            for name in results:
+                print(name, "ave_one_percent_recall: ", results[name][2])
+        else:
+            ave_recall, average_similarity_score, ave_one_percent_recall = evaluate.evaluate_model(para.model, tqdm_flag=True)
 
-        print("ave_one_percent_recall: ",ave_one_percent_recall)
+            print("ave_one_percent_recall: ",ave_one_percent_recall)
     else:
         train()
     print("finish")
\ No newline at end of file
@@ -8,10 +8,11 @@ import numpy as np
 import torch.nn.functional as F
 import math
 from util.lpdnet_model import LPDNet,LPDNetOrign
+from util.amp import autocast
 
 class NetVLADLoupe(nn.Module):
     def __init__(self, feature_size, max_samples, cluster_size, output_dim,
-                 gating=True, add_batch_norm=True, is_training=True):
+                 gating=True, add_batch_norm=True, is_training=True, hidden_rank=0):
         super(NetVLADLoupe, self).__init__()
         self.feature_size = feature_size
         self.max_samples = max_samples
@@ -25,8 +26,18 @@ class NetVLADLoupe(nn.Module):
             feature_size, cluster_size) * 1 / math.sqrt(feature_size))
         self.cluster_weights2 = nn.Parameter(torch.randn(
             1, feature_size, cluster_size) * 1 / math.sqrt(feature_size))
-        self.hidden1_weights = nn.Parameter(
-            torch.randn(cluster_size * feature_size, output_dim) * 1 / math.sqrt(feature_size))
+        # hidden_rank>0时把[cluster_size*feature_size, output_dim]的降维矩阵分解成两个低秩矩阵
+        self.hidden_rank = hidden_rank
+        if hidden_rank > 0:
+            self.hidden1_weights_u = nn.Parameter(
+                torch.randn(cluster_size * feature_size, hidden_rank) * 1 / math.sqrt(feature_size))
+            self.hidden1_weights_v = nn.Parameter(
+                torch.randn(hidden_rank, output_dim) * 1 / math.sqrt(hidden_rank))
+        else:
+            self.hidden1_weights = nn.Parameter(
+                torch.randn(cluster_size * feature_size, output_dim) * 1 / math.sqrt(feature_size))
+        # int8推理时由util/quantize.py换成(量化的)nn.Linear
+        self.hidden1 = None
 
         if add_batch_norm:
             self.cluster_biases = None
@@ -43,37 +54,32 @@ class NetVLADLoupe(nn.Module):
                 output_dim, add_batch_norm=add_batch_norm)
 
     def forward(self, x):
-        x = x.transpose(1, 3).contiguous()
-        x = x.view((-1, self.max_samples, self.feature_size))
-        activation = torch.matmul(x, self.cluster_weights)
+        # [B,emb_dims,num,1]直接作为[B,feature_size,max_samples]使用，不再transpose拷贝
+        x = x.reshape((-1, self.feature_size, self.max_samples))
+        activation = torch.matmul(self.cluster_weights.t(), x)  # [B,cluster_size,max_samples]
         if self.add_batch_norm:
-            # activation = activation.transpose(1,2).contiguous()
-            activation = activation.view(-1, self.cluster_size)
+            # 通道在第1维，与对[B*max_samples, cluster_size]做BatchNorm1d等价
             activation = self.bn1(activation)
-            activation = activation.view(-1,
-                                         self.max_samples, self.cluster_size)
-            # activation = activation.transpose(1,2).contiguous()
         else:
-            activation = activation + self.cluster_biases
-        activation = self.softmax(activation)
-        activation = activation.view((-1, self.max_samples, self.cluster_size))
+            activation = activation + self.cluster_biases.view(1, -1, 1)
+        activation = F.softmax(activation, dim=1)
 
-        a_sum = activation.sum(-2, keepdim=True)
+        a_sum = activation.sum(-1).unsqueeze(1)  # [B,1,cluster_size]
         a = a_sum * self.cluster_weights2
 
-        activation = torch.transpose(activation, 2, 1)
-        x = x.view((-1, self.max_samples, self.feature_size))
-        vlad = torch.matmul(activation, x)
-        vlad = torch.transpose(vlad, 2, 1)
+        vlad = torch.matmul(x, activation.transpose(2, 1))  # [B,feature_size,cluster_size]
         vlad = vlad - a
 
         vlad = F.normalize(vlad, dim=1, p=2)
-        # print(vlad.shape,self.cluster_size,self.feature_size,self.cluster_size * self.feature_size)
-        # 这里用view报错，跟contiguous有关系
-        vlad = vlad.reshape((-1, self.cluster_size * self.feature_size))
+        vlad = vlad.view((-1, self.cluster_size * self.feature_size))
         vlad = F.normalize(vlad, dim=1, p=2)
 
-        vlad = torch.matmul(vlad, self.hidden1_weights)
+        if self.hidden1 is not None:
+            vlad = self.hidden1(vlad)
+        elif self.hidden_rank > 0:
+            vlad = torch.matmul(torch.matmul(vlad, self.hidden1_weights_u), self.hidden1_weights_v)
+        else:
+            vlad = torch.matmul(vlad, self.hidden1_weights)
 
         vlad = self.bn2(vlad)
 
@@ -82,6 +88,21 @@ class NetVLADLoupe(nn.Module):
 
         return vlad
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧checkpoint只有完整的hidden1_weights，加载到低秩模型时用截断SVD转换
+        key = prefix + 'hidden1_weights'
+        if self.hidden_rank > 0 and key in state_dict:
+            state_dict[prefix + 'hidden1_weights_u'], state_dict[prefix + 'hidden1_weights_v'] = \
+                factorize_hidden1_weights(state_dict.pop(key), self.hidden_rank)
+        super(NetVLADLoupe, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def factorize_hidden1_weights(weights, rank):
+    # 截断SVD把hidden1_weights [cluster_size*feature_size, output_dim]分解成rank阶的u @ v，奇异值平分给u和v
+    u, s, v = torch.svd(weights.float())
+    s = s[:rank].sqrt()
+    return (u[:, :rank] * s).to(weights.dtype), (s.unsqueeze(1) * v[:, :rank].t()).to(weights.dtype)
+
 
 class GatingContext(nn.Module):
     def __init__(self, dim, add_batch_norm=True):
@@ -172,8 +193,7 @@ class STN3d(nn.Module):
 
         iden = Variable(torch.from_numpy(np.eye(self.k).astype(np.float32))).view(
             1, self.k*self.k).repeat(batchsize, 1)
-        if x.is_cuda:
-            iden = iden.cuda()
+        iden = iden.to(x.device)
         x = x + iden
         x = x.view(-1, self.k, self.k)
         return x
@@ -242,23 +262,35 @@ class PointNetfeat(nn.Module):
 
 
 class PointNetVlad(nn.Module):
-    def __init__(self, num_points=4096, global_feat=True, feature_transform=False, max_pool=False, output_dim=256, emb_dims = 1024, featnet = "lpdnet", xyz_trans=False):
+    def __init__(self, num_points=4096, global_feat=True, feature_transform=False, max_pool=False, output_dim=256, emb_dims = 1024, featnet = "lpdnet", xyz_trans=False, spatial_knn="dense", vlad_rank=0, grad_checkpoint=False):
         super(PointNetVlad, self).__init__()
         if featnet == "lpdnet":
-            self.emb_nn = LPDNet(emb_dims=emb_dims, tfea=feature_transform, t3d=xyz_trans)
+            self.emb_nn = LPDNet(emb_dims=emb_dims, tfea=feature_transform, t3d=xyz_trans, spatial_knn=spatial_knn,
+                                 grad_checkpoint=grad_checkpoint)
         elif featnet == "pointnet":
             self.emb_nn = None
             self.point_net = PointNetfeat(num_points=num_points, global_feat=global_feat,
                                       feature_transform=feature_transform, max_pool=max_pool, emb_dims = emb_dims)
         elif featnet == "lpdnetorigin":
-            self.emb_nn = LPDNetOrign(emb_dims=emb_dims, tfea=feature_transform, t3d=xyz_trans)
+            self.emb_nn = LPDNetOrign(emb_dims=emb_dims, tfea=feature_transform, t3d=xyz_trans, spatial_knn=spatial_knn,
+                                      grad_checkpoint=grad_checkpoint)
         else:
             print("featnet error")
         self.net_vlad = NetVLADLoupe(feature_size=emb_dims, max_samples=num_points, cluster_size=64,
                                      output_dim=output_dim, gating=True, add_batch_norm=True,
-                                     is_training=True)
+                                     is_training=True, hidden_rank=vlad_rank)
+        # --amp时为torch.bfloat16/torch.float16
+        self.amp_dtype = None
 
     def forward(self, x):
+        if self.amp_dtype is None:
+            return self.forward_features(x)
+        # 混合精度只作用于网络内部，输出的描述子和之后的loss仍为fp32
+        with autocast(x.device.type, self.amp_dtype):
+            x = self.forward_features(x)
+        return x.float()
+
+    def forward_features(self, x):
         # print("input x: ",x.shape)
         if self.emb_nn is not None:
             x = self.emb_nn(x)
@@ -273,10 +305,11 @@ class PointNetVlad(nn.Module):
 if __name__ == '__main__':
     num_points = 4096
     sim_data = Variable(torch.rand(44, 1, num_points, 3))
-    sim_data = sim_data.cuda()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sim_data = sim_data.to(device)
 
     pnv = PointNetVlad.PointNetVlad(global_feat=True, feature_transform=True, max_pool=False,
-                                    output_dim=256, num_points=num_points).cuda()
+                                    output_dim=256, num_points=num_points).to(device)
     pnv.train()
     out3 = pnv(sim_data)
     print('pnv', out3.size())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import contextlib
+import time
+import torch
+
+# --amp的取值，bf16在cpu和gpu上都可用，fp16只在gpu上用并需要loss scaling
+AMP_DTYPES = {"off": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(device_type, dtype):
+    # 旧版本torch没有torch.autocast，直接以fp32运行
+    if dtype is None or not hasattr(torch, "autocast"):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, dtype=dtype)
+
+
+def autocast_off(device_type):
+    if not hasattr(torch, "autocast"):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, enabled=False)
+
+
+def grad_scaler(dtype, device):
+    # fp16在cuda上动态缩放loss，其他情况直接透传（bf16的指数范围与fp32相同）
+    return torch.cuda.amp.GradScaler(enabled=dtype == torch.float16 and device.type == "cuda")
+
+
+def activation_bytes(fn):
+    # 运行fn()，返回结果和autograd为backward保存的tensor字节数，即一个训练step占用的激活内存，cpu和gpu上统计方式相同
+    saved = {}
+
+    def pack(tensor):
+        saved[(tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        result = fn()
+    return result, sum(saved.values())
+
+
+def benchmark(model, feed_tensor, dtype, steps=3):
+    # model.amp_dtype = dtype时前向+反向的激活字节数和每秒处理的点云数
+    old_dtype = model.amp_dtype
+    model.amp_dtype = dtype
+    model.train()
+    try:
+        # 第一次前向包含cudnn/内存分配的预热，不计时
+        output, saved = activation_bytes(lambda: model(feed_tensor))
+        output.sum().backward()
+        if feed_tensor.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(steps):
+            model(feed_tensor).sum().backward()
+        if feed_tensor.is_cuda:
+            torch.cuda.synchronize()
+        throughput = steps * feed_tensor.size(0) / (time.time() - start)
+    finally:
+        model.amp_dtype = old_dtype
+        model.zero_grad()
+    return saved, throughput
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import numpy as np
+
+
+def squared_distances(queries, vectors, vector_norms=None):
+    # [B,D] x [N,D] -> [B,N]
+    if vector_norms is None:
+        vector_norms = (vectors ** 2).sum(1)
+    dist = (queries ** 2).sum(1)[:, None] - 2 * queries.dot(vectors.T) + vector_norms[None, :]
+    return np.maximum(dist, 0)
+
+
+def top_k(dist, k):
+    # 每行最小的k个的位置，由近到远
+    k = min(k, dist.shape[1])
+    nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(nearest, np.take_along_axis(dist, nearest, axis=1).argsort(axis=1), axis=1)
+
+
+def exact_search(vectors, queries, k):
+    dist = squared_distances(np.asarray(queries, dtype=np.float32), vectors)
+    nearest = top_k(dist, k)
+    return nearest, np.take_along_axis(dist, nearest, axis=1)
+
+
+class IVFIndex(object):
+    # [N,D]向量上的倒排索引：按最近的k-means中心（默认sqrt(N)个）分桶，与CSRSet一样存成一个order数组并用ptr划分
+    # 搜索时只扫描中心离query最近的nprobe个桶，每个桶与探查它的所有query做一次矩阵乘
+    def __init__(self, vectors, num_lists=None, iters=10, sample=20000, seed=0):
+        # 自己保存一份，update之外的修改不影响索引
+        self.vectors = np.array(vectors, dtype=np.float32)
+        self.norms = (self.vectors ** 2).sum(1)
+        num = len(self.vectors)
+        if num_lists is None:
+            num_lists = int(np.sqrt(num))
+        num_lists = max(1, min(num_lists, num))
+        rng = np.random.RandomState(seed)
+        # 在采样的子集上做k-means
+        train = self.vectors[rng.choice(num, min(sample, num), replace=False)]
+        centroids = train[rng.choice(len(train), num_lists, replace=False)].copy()
+        for _ in range(iters):
+            assign = squared_distances(train, centroids).argmin(1)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=num_lists)
+            nonempty = np.flatnonzero(counts)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+            # 空的簇保留原来的中心
+            centroids[nonempty] = np.add.reduceat(train[order], starts, axis=0) / counts[nonempty, None]
+        self.centroids = centroids
+        assign = squared_distances(self.vectors, centroids).argmin(1)
+        self.order = np.argsort(assign, kind='stable')
+        self.ptr = np.zeros(num_lists + 1, dtype=np.int64)
+        self.ptr[1:] = np.cumsum(np.bincount(assign, minlength=num_lists))
+        # 按桶排好的副本，每个桶是连续的一段，搜索时不需要gather
+        self.position = np.empty(num, dtype=np.int64)
+        self.position[self.order] = np.arange(num)
+        self.list_vectors = self.vectors[self.order]
+        self.list_norms = self.norms[self.order]
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def update(self, rows, vectors):
+        # 替换部分向量，桶的划分不变，距离仍然精确
+        self.vectors[rows] = vectors
+        self.norms[rows] = (self.vectors[rows] ** 2).sum(1)
+        self.list_vectors[self.position[rows]] = self.vectors[rows]
+        self.list_norms[self.position[rows]] = self.norms[rows]
+
+    def search(self, queries, k, nprobe=8, exclude=None):
+        # queries [B,D]的近似k近邻，返回ids和平方距离 [B,k]，由近到远
+        # exclude(ids)把[B,W]的候选映射成要跳过的mask；候选不足k个的行用id -1、距离inf补齐
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe, len(self.centroids))
+        probe = top_k(squared_distances(queries, self.centroids), nprobe)  # [B,nprobe]
+        counts = self.ptr[probe + 1] - self.ptr[probe]
+        # 每行把nprobe个倒排列表首尾相接，第j个列表从columns[:, j]开始
+        columns = counts.cumsum(1) - counts
+        width = max(int(counts.sum(1).max()), k)
+        ids = np.full((len(queries), width), -1, dtype=np.int64)
+        dist = np.full((len(queries), width), np.inf, dtype=np.float32)
+        query_norms = (queries ** 2).sum(1)
+        # 按桶分组，探查同一个桶的query与桶内向量做一次矩阵乘
+        flat = probe.reshape(-1)
+        grouped = np.argsort(flat, kind='stable')
+        bounds = np.flatnonzero(np.diff(flat[grouped])) + 1
+        for group in np.split(grouped, bounds):
+            bucket = flat[group[0]]
+            start, end = self.ptr[bucket], self.ptr[bucket + 1]
+            if start == end:
+                continue
+            rows, slots = group // nprobe, group % nprobe
+            block = query_norms[rows, None] - 2 * queries[rows].dot(self.list_vectors[start:end].T) \
+                + self.list_norms[None, start:end]
+            cols = columns[rows, slots][:, None] + np.arange(end - start)[None, :]
+            ids[rows[:, None], cols] = self.order[start:end][None, :]
+            dist[rows[:, None], cols] = np.maximum(block, 0)
+        if exclude is not None:
+            dist[(ids >= 0) & exclude(np.maximum(ids, 0))] = np.inf
+        nearest = top_k(dist, k)
+        ids = np.take_along_axis(ids, nearest, axis=1)
+        dist = np.take_along_axis(dist, nearest, axis=1)
+        ids[np.isinf(dist)] = -1
+        return ids, dist
+
+
+def compare_exact(index, queries, k, nprobe=8):
+    # index.search与精确搜索在queries上的耗时，以及找到的精确k近邻的比例
+    start = time.time()
+    ids, _ = index.search(queries, k, nprobe)
+    ivf_time = time.time() - start
+    start = time.time()
+    exact, _ = exact_search(index.vectors, queries, k)
+    exact_time = time.time() - start
+    found = (ids[:, :, None] == exact[:, None, :]).any(axis=1)
+    return {"ivf_ms": 1000 * ivf_time, "exact_ms": 1000 * exact_time, "recall": float(found.mean())}
+
+
+if __name__ == '__main__':
+    # 合成的聚类数据上比较IVF与精确搜索，规模与训练集相近
+    rng = np.random.RandomState(0)
+    centers = rng.randn(200, 256).astype(np.float32)
+    vectors = centers[rng.randint(0, 200, 21000)] + 0.3 * rng.randn(21000, 256).astype(np.float32)
+    start = time.time()
+    index = IVFIndex(vectors)
+    print("build: %.1f ms, lists: %d" % (1000 * (time.time() - start), len(index.centroids)))
+    queries = vectors[rng.choice(len(vectors), 256, replace=False)]
+    for nprobe in (1, 4, 8, 16):
+        print("nprobe", nprobe, compare_exact(index, queries, 10, nprobe))
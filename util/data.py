@@ -1,136 +1,126 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import glob
+from time import time
 import os
 import numpy as np
 from scipy.spatial.transform import Rotation
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 from loading_pointclouds import *
-from sklearn.neighbors import KDTree
 import torch
 import util.initPara as para
 from util.initPara import log_string
 from tqdm import tqdm
+from util.sampler import TupleSampler
+from util.pipeline import embed
+from util.ann_index import IVFIndex, compare_exact
+from util.distributed import is_distributed, is_main_process, barrier, shard, all_gather_array, unwrap
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # Load dictionary of training queries
 if not para.args.eval:
-    # TRAINING_QUERIES = get_queries_dict(cfg.TRAIN_FILE)
-    # TEST_QUERIES = get_queries_dict(cfg.TEST_FILE)
-    TRAINING_QUERIES = get_queries_dict(cfg.TRAIN_FILE_EASY)
-    TEST_QUERIES = get_queries_dict(cfg.TEST_FILE_EASY)
+    # TRAINING_QUERIES = get_queries_index(cfg.TRAIN_FILE)
+    # TEST_QUERIES = get_queries_index(cfg.TEST_FILE)
+    TRAINING_QUERIES = get_queries_index(cfg.TRAIN_FILE_EASY)
+    TEST_QUERIES = get_queries_index(cfg.TEST_FILE_EASY)
 else:
     TRAINING_QUERIES = []
     TEST_QUERIES = []
-HARD_NEGATIVES = {}
 TRAINING_LATENT_VECTORS = []
+# --hard_neg_index=ivf时TRAINING_LATENT_VECTORS上的IVF索引，随update_vectors重建
+LATENT_INDEX = None
+# TRAINING_LATENT_VECTORS每一行最后一次计算时的TOTAL_ITERATIONS，以及滚动刷新的下一行
+LATENT_ITERATION = []
+REFRESH_CURSOR = 0
 TRAINING_POINT_CLOUD = []
 
 load_fast=para.args.load_fast
+TRAINING_POINT_CLOUD_FILE = "./generating_queries/TRAINING_POINT_CLOUD.npy"
+
+
+def build_training_point_cloud(filename, chunk=1024):
+    # 逐行写入float32的npy，不需要把整个训练集放进内存
+    tmp = filename + ".tmp"
+    if os.path.exists(filename):
+        # 旧版本保存的是float64，分块转换成float32
+        old = np.load(filename, mmap_mode='r')
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=old.shape)
+        for start in tqdm(range(0, old.shape[0], chunk)):
+            out[start:start + chunk] = old[start:start + chunk]
+        del old
+    else:
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                        shape=(len(TRAINING_QUERIES), cfg.NUM_POINTS, 3))
+        for i in tqdm(range(len(TRAINING_QUERIES))):
+            out[i] = load_pc_file(TRAINING_QUERIES.files[i])
+    out.flush()
+    del out
+    os.replace(tmp, filename)
+
+
 # 这里最好能跟数据生成同步
 if load_fast and not para.args.eval:
     log_string("start load fast")
-    DIR="./generating_queries/"
-    if os.path.exists(DIR+"TRAINING_POINT_CLOUD.npy"):
-        TRAINING_POINT_CLOUD = np.load(DIR+"TRAINING_POINT_CLOUD.npy")
-        log_string("load npy")
-    else:
-        for i in tqdm(range(len(TRAINING_QUERIES))):
-            filename = TRAINING_QUERIES[i]["query"]
-            pc = load_pc_file(filename)
-            TRAINING_POINT_CLOUD.append(pc)
-        TRAINING_POINT_CLOUD = np.asarray(TRAINING_POINT_CLOUD).reshape(-1,4096,3)
-        np.save(DIR+"TRAINING_POINT_CLOUD.npy", TRAINING_POINT_CLOUD)
+    # 多进程训练时由rank 0生成npy，其他rank等它写完
+    if is_main_process() and (not os.path.exists(TRAINING_POINT_CLOUD_FILE) or
+                              np.load(TRAINING_POINT_CLOUD_FILE, mmap_mode='r').dtype != np.float32):
+        build_training_point_cloud(TRAINING_POINT_CLOUD_FILE)
         log_string("save npy")
+    barrier()
+    # 只读mmap，DataLoader的worker和update_vectors通过page cache共享同一份数据
+    TRAINING_POINT_CLOUD = np.load(TRAINING_POINT_CLOUD_FILE, mmap_mode='r')
+    log_string("load npy")
 else:
     TRAINING_POINT_CLOUD = []
     log_string("load_fast "+str(load_fast))
 
-def flat(l):
-    for k in l:
-        if not isinstance(k, (list, tuple)):
-            yield k
-        else:
-            yield from flat(k)
+def worker_init_fn(worker_id):
+    # fork出的worker会继承相同的numpy随机状态，需要各自重新设置
+    np.random.seed(torch.initial_seed() % 2 ** 32)
 
-def get_query_tuple_fast(item, dict_value, num_pos, num_neg, QUERY_DICT, hard_neg=[], other_neg=False):
-    # get query tuple for dictionary entry
-    # return list [query,positives,negatives]
-    start = time()
-    query = TRAINING_POINT_CLOUD[item] # 就一个点云
-    random.shuffle(dict_value["positives"])
-    # 不必考虑正样本是否充足，因为之前判断过
-    positives = TRAINING_POINT_CLOUD[(dict_value["positives"][:num_pos])]
-
-    neg_indices = []
-    if(len(hard_neg) == 0):
-        random.shuffle(dict_value["negatives"])
-        neg_indices=dict_value["negatives"][:num_neg]
-    else:
-        neg_indices.append(hard_neg)
-        j = 0
-        # 如果hard不够，再进行补充
-        neg_indices = list(flat(neg_indices))
-        while(len(neg_indices) < num_neg):
-            if not dict_value["negatives"][j] in hard_neg:
-                neg_indices.append(dict_value["negatives"][j])
-            j += 1
-    neg_indices = list(flat(neg_indices))
-    negatives = TRAINING_POINT_CLOUD[neg_indices]
-
-    # log_string("load time: ",time()-start)
-    # 是否需要额外的neg（Quadruplet loss需要）
-    if other_neg is False:
-        return [query, positives, negatives]
+
+def get_loader(dataset, batch_size):
+    # sampler一次给出一个batch的位置，dataset一次完成整个batch的采样和读取
+    sampler = dataset.batch_sampler(batch_size)
+    return DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=4, worker_init_fn=worker_init_fn)
+
+
+def query_sampler(dataset):
+    # DDP时每个rank只取自己那一份query，各rank的batch数相同
+    if is_distributed():
+        return DistributedSampler(dataset, shuffle=False)
+    return SequentialSampler(dataset)
+
+
+def load_tuples(items, positives, negatives, other_neg):
+    # 所有点云用一次fancy index取出 [B, 1+num_pos+num_neg+1, num, 3]
+    indices = np.concatenate((items[:, None], positives, negatives, other_neg[:, None]), axis=1)
+    if load_fast:
+        pcs = TRAINING_POINT_CLOUD[indices.reshape(-1)]
     else:
-        # get neighbors of negatives and query
-        neighbors = []
-        for pos in dict_value["positives"]:
-            neighbors.append(pos)
-        for neg in neg_indices:
-            for pos in QUERY_DICT[neg]["positives"]:
-                neighbors.append(pos)
-        # 减去与neighbors公共有的部分，剩下既不进也不远的那些部分
-        neighbors = list(flat(neighbors))
-        possible_negs = list(set(QUERY_DICT.keys())-set(neighbors))
-        random.shuffle(possible_negs)
-        if(len(possible_negs) == 0):
-            return [query, positives, negatives, np.array([])]
-        neg2 = TRAINING_POINT_CLOUD[possible_negs[0]] # 就一个
-
-        return [query, positives, negatives, neg2]
-
-def get_random_hard_negatives(query_vec, random_negs, hard_neg_num):
-    global TRAINING_LATENT_VECTORS
-
-    latent_vecs = []
-    for j in range(len(random_negs)):
-        latent_vecs.append(TRAINING_LATENT_VECTORS[random_negs[j]])
-
-    latent_vecs = np.array(latent_vecs)
-    nbrs = KDTree(latent_vecs)
-    distances, indices = nbrs.query(np.array([query_vec]), k=hard_neg_num)
-    hard_negs = np.squeeze(np.array(random_negs)[indices[0]])
-    hard_negs = hard_negs.tolist()
-    return hard_negs
-
-def get_feature_representation(filename, model):
-    model.eval()
-    queries = load_pc_files([filename])
-    queries = np.expand_dims(queries, axis=1)
-    # if(BATCH_NUM_QUERIES-1>0):
-    #    fake_queries=np.zeros((BATCH_NUM_QUERIES-1,1,NUM_POINTS,3))
-    #    q=np.vstack((queries,fake_queries))
-    # else:
-    #    q=queries
-    with torch.no_grad():
-        q = torch.from_numpy(queries).float()
-        q = q.to(device)
-        output = model(q)
-    output = output.detach().cpu().numpy()
-    output = np.squeeze(output)
-    model.train()
-    return output
+        pcs = load_pc_files(TRAINING_QUERIES.files[indices.reshape(-1)])
+    if pcs.shape[0] != indices.size:
+        return None
+    pcs = np.asarray(pcs, dtype=np.float32).reshape(indices.shape + pcs.shape[1:])
+    sections = np.cumsum([1, positives.shape[1], negatives.shape[1]])
+    return np.split(pcs, sections, axis=1)
+
+def in_batch_negatives(items, indices):
+    # [B, B*tuple_size]：batch中每个子图（与load_tuples相同的顺序）是否在query的50m邻居以外
+    return ~TRAINING_QUERIES.neighbors.contains(items[:, None], indices.reshape(1, -1))
+
+def get_hard_negatives(items, negatives, hard_neg_num):
+    # negatives [B,S]中在TRAINING_LATENT_VECTORS里离每个query最近的hard_neg_num个，由近到远
+    negatives = np.asarray(negatives, dtype=np.int64)
+    if hard_neg_num <= 0:
+        return negatives[:, :0]
+    query_vecs = TRAINING_LATENT_VECTORS[items]  # [B,D]
+    dist = ((TRAINING_LATENT_VECTORS[negatives] - query_vecs[:, None]) ** 2).sum(-1)  # [B,S]
+    # 只需要前k个，argpartition后再对这k个排序
+    nearest = np.argpartition(dist, hard_neg_num - 1, axis=1)[:, :hard_neg_num]
+    nearest = np.take_along_axis(nearest, np.take_along_axis(dist, nearest, axis=1).argsort(axis=1), axis=1)
+    return np.take_along_axis(negatives, nearest, axis=1)
 
 # 设置成随机抽取的
 class Oxford_train_base(Dataset):
@@ -138,217 +128,195 @@ class Oxford_train_base(Dataset):
         self.num_points = args.num_points
         self.positives_per_query=args.positives_per_query
         self.negatives_per_query=args.negatives_per_query
-        self.train_len=len(TRAINING_QUERIES.keys())
-        # self.train_file_items = np.random.permutation(np.arange(0, self.train_len))
-        # self.train_file_items = np.arange(0, self.train_len)
+        self.sampler = TupleSampler(TRAINING_QUERIES, self.positives_per_query, self.negatives_per_query)
+        # in-batch loss需要batch内所有子图对每个query是否为负样本
+        self.in_batch = args.loss_function.startswith('in_batch')
+        # 正样本不足的query不参与训练
+        self.queries = self.sampler.valid_queries()
+        self.train_len = len(self.queries)
         log_string('Load Oxford Dataset')
-        # self.data, self.label = []
         self.last = []
         print(self.train_len)
-    def __getitem__(self, item):
-        if (len(TRAINING_QUERIES[item]["positives"]) < self.positives_per_query):
-            if self.last==[]:
-                log_string("wrong")
-            else:
-                return self.last[0], self.last[1], self.last[2], self.last[3]
-        # no cached feature vectors
-        if load_fast:
-            q_tuples=get_query_tuple_fast(item, TRAINING_QUERIES[item], self.positives_per_query, self.negatives_per_query,
-                                TRAINING_QUERIES, hard_neg=[], other_neg=True)
-        else:
-            q_tuples = get_query_tuple(TRAINING_QUERIES[item], self.positives_per_query, self.negatives_per_query,
-                                    TRAINING_QUERIES, hard_neg=[], other_neg=True)
-        # 对点云进行增强，旋转或者加噪声
-        # q_tuples.append(get_rotated_tuple(TRAINING_QUERIES[item],POSITIVES_PER_QUERY,NEGATIVES_PER_QUERY, TRAINING_QUERIES, hard_negs, other_neg=True))
-        # q_tuples.append(get_jittered_tuple(TRAINING_QUERIES[item],POSITIVES_PER_QUERY,NEGATIVES_PER_QUERY, TRAINING_QUERIES, hard_negs, other_neg=True))
-
-        # 这里默认使用了quadruplet loss，所以必须找到other_neg
-        if (q_tuples[3].shape[0] != self.num_points):
-            log_string('----' + 'FAULTY other_neg' + '-----')
-            if self.last==[]:
-                log_string("wrong")
-            else:
-                return self.last[0], self.last[1], self.last[2], self.last[3]
 
-        queries = np.expand_dims(np.array(q_tuples[0], dtype=np.float32), axis=0)
-        other_neg = np.expand_dims(np.array(q_tuples[3], dtype=np.float32), axis=0)
-        positives = np.array(q_tuples[1], dtype=np.float32)
-        negatives = np.array(q_tuples[2], dtype=np.float32)
+    def batch_sampler(self, batch_size):
+        return BatchSampler(query_sampler(self), batch_size, drop_last=True)
 
-        if (len(queries.shape) != 3):
+    # items是BatchSampler给出的一个batch的位置
+    def __getitem__(self, items):
+        items = self.queries[np.asarray(items)]
+        positives, negatives, other_neg = self.sampler.sample(items)
+        return self.get_tuples(items, positives, negatives, other_neg)
+
+    def get_tuples(self, items, positives, negatives, other_neg):
+        q_tuples = load_tuples(items, positives, negatives, other_neg)
+        if q_tuples is None:
             log_string('----' + 'FAULTY QUERY' + '-----')
             if self.last==[]:
                 log_string("wrong")
-            else:
-                return self.last[0], self.last[1], self.last[2], self.last[3]
-        self.last = [queries, positives, negatives, other_neg]
-        return queries.astype('float32'), positives.astype('float32'), negatives.astype('float32'), other_neg.astype('float32')
+            return self.last
+        # queries [B,1,num,3] positives [B,num_pos,num,3] negatives [B,num_neg,num,3] other_neg [B,1,num,3]
+        # 之后是这些点云在训练集中的序号 [B, tuple_size]，训练时的描述子按序号写回TRAINING_LATENT_VECTORS
+        q_tuples.append(np.concatenate((items[:, None], positives, negatives, other_neg[:, None]), axis=1))
+        if self.in_batch:
+            q_tuples.append(in_batch_negatives(items, q_tuples[4]))
+        self.last = q_tuples
+        return q_tuples
 
     def __len__(self):
         return self.train_len
 
-class Oxford_train_advance(Dataset):
+class Oxford_train_advance(Oxford_train_base):
     def __init__(self, args):
-        self.num_points = args.num_points
-        self.positives_per_query = args.positives_per_query
-        self.negatives_per_query = args.negatives_per_query
-        self.train_len = len(TRAINING_QUERIES.keys())
-        # self.train_file_items = np.random.permutation(np.arange(0, self.train_len))
-        # self.train_file_items = np.arange(0, self.train_len)
-        log_string('Load Oxford Dataset')
-        # self.data, self.label = []
+        super(Oxford_train_advance, self).__init__(args)
         self.sampled_neg = 4000
+        self.nprobe = args.ivf_nprobe
         self.hard_neg_num = args.hard_neg_per_query
         if self.hard_neg_num > args.negatives_per_query:
             log_string("self.hard_neg_num >  args.negatives_per_query")
-        self.last=[]
-    def __getitem__(self, item):
-        if (len(TRAINING_QUERIES[item]["positives"]) < self.positives_per_query):
-            # log_string("lack positive")
-            if self.last==[]:
-                log_string("wrong")
-            else:
-                return self.last[0], self.last[1], self.last[2], self.last[3]
-        if (len(HARD_NEGATIVES.keys()) == 0):
-            from time import time
-            start = time()
-            query = get_feature_representation(TRAINING_QUERIES[item]['query'], para.model)
-            # log_string("data: ",time()-start)
-            random.shuffle(TRAINING_QUERIES[item]['negatives'])
-            # log_string("data: ",time()-start)
-            negatives = TRAINING_QUERIES[item]['negatives'][0:self.sampled_neg]
-            # log_string("data: ",time()-start)
-            # 找到离当前query最近的neg KDtree比较耗时
-            hard_negs = get_random_hard_negatives(query, negatives, self.hard_neg_num)
-            # log_string("data: ",time()-start)
-            # log_string(hard_negs)
-            if load_fast:
-                q_tuples=get_query_tuple_fast(item, TRAINING_QUERIES[item], self.positives_per_query, self.negatives_per_query,
-                                TRAINING_QUERIES, hard_neg=hard_negs, other_neg=True)
-            else:
-                q_tuples=get_query_tuple(TRAINING_QUERIES[item], self.positives_per_query, self.negatives_per_query,
-                                TRAINING_QUERIES, hard_neg = hard_negs, other_neg=True)
-            # log_string("data: ",time()-start)
-        #     如果指定了一些HARD_NEGATIVES，實際沒有
-        else:
-            query = get_feature_representation(
-                TRAINING_QUERIES[item]['query'], para.model)
-            random.shuffle(TRAINING_QUERIES[item]['negatives'])
-            negatives = TRAINING_QUERIES[item
-                        ]['negatives'][0:self.sampled_neg]
-            hard_negs = get_random_hard_negatives(
-                query, negatives, self.hard_neg_num)
-            hard_negs = list(set().union(
-                HARD_NEGATIVES[item], hard_negs))
-            # log_string('hard', hard_negs)
-            if load_fast:
-                q_tuples=get_query_tuple_fast(item, TRAINING_QUERIES[item], self.positives_per_query, self.negatives_per_query,
-                                TRAINING_QUERIES, hard_neg=hard_negs, other_neg=True)
-            else:
-                q_tuples=get_query_tuple(TRAINING_QUERIES[item], self.positives_per_query, self.negatives_per_query,
-                                TRAINING_QUERIES, hard_negs, other_neg=True)
-
-        # 这里默认使用了quadruplet loss，所以必须找到other_neg
-        if (q_tuples[3].shape[0] != self.num_points):
-            log_string('----' + 'FAULTY other_neg' + '-----')
-            if self.last==[]:
-                log_string("wrong")
-            else:
-                return self.last[0], self.last[1], self.last[2], self.last[3]
 
-        queries = np.expand_dims(np.array(q_tuples[0], dtype=np.float32), axis=0)
-        other_neg = np.expand_dims(np.array(q_tuples[3], dtype=np.float32), axis=0)
-        positives = np.array(q_tuples[1], dtype=np.float32)
-        negatives = np.array(q_tuples[2], dtype=np.float32)
-
-        if (len(queries.shape) != 3):
-            log_string('----' + 'FAULTY QUERY' + '-----')
-            if self.last==[]:
-                log_string("wrong")
-            else:
-                return self.last[0], self.last[1], self.last[2], self.last[3]
-        self.last = [queries, positives, negatives, other_neg]
-        return queries.astype('float32'), positives.astype('float32'), negatives.astype('float32'), other_neg.astype('float32')
+    # 由HardNegativeBatchSampler在主进程中给出(batch的位置, 困难负样本)
+    def __getitem__(self, batch):
+        items, hard_negs = batch
+        items = self.queries[np.asarray(items)]
+        positives, negatives, other_neg = self.sampler.sample(items, hard_negs=hard_negs)
+        return self.get_tuples(items, positives, negatives, other_neg)
+
+    def batch_sampler(self, batch_size):
+        return HardNegativeBatchSampler(self, batch_size)
+
+    def mine(self, positions):
+        items = self.queries[np.asarray(positions)]
+        if LATENT_INDEX is not None:
+            return self.mine_index(items)
+        # 从随机抽取的sampled_neg个负样本中找出描述子离query最近的
+        negatives = self.sampler.sample_negatives(items, self.sampled_neg)
+        return get_hard_negatives(items, negatives, self.hard_neg_num)
+
+    def mine_index(self, items):
+        # 在整个训练集上近似搜索，跳过query 50m以内的子图
+        exclude = lambda ids: TRAINING_QUERIES.neighbors.contains(items[:, None], ids)
+        hard_negs, _ = LATENT_INDEX.search(TRAINING_LATENT_VECTORS[items], self.hard_neg_num,
+                                           self.nprobe, exclude=exclude)
+        # 探查的列表里负样本不够时，只把-1的位置补成随机负样本，找到的困难负样本保留
+        short = (hard_negs < 0).any(axis=1)
+        if short.any():
+            found = hard_negs[short]
+            missing = found < 0
+            fill = self.sampler.sample_negatives(items[short], self.hard_neg_num, exclude=found)
+            found[missing] = fill[missing]
+            hard_negs[short] = found
+        return hard_negs
+
+
+class HardNegativeBatchSampler(object):
+    # 为Oxford_train_advance给出(positions, hard_negs)
+    # sampler在主进程中运行，困难负样本用当前的TRAINING_LATENT_VECTORS挖掘，worker只负责采样和读取点云，不做模型前向
+    def __init__(self, dataset, batch_size):
+        self.dataset = dataset
+        self.batches = BatchSampler(query_sampler(dataset), batch_size, drop_last=True)
+
+    def __iter__(self):
+        for positions in self.batches:
+            yield positions, self.dataset.mine(positions)
 
     def __len__(self):
-        return self.train_len
+        return len(self.batches)
 
 
-def update_vectors(args, model, tqdm_flag=True):
-    global TRAINING_LATENT_VECTORS
+def embed_rows(args, model, rows, tqdm_flag=False, depth=None):
+    # 用eval模式计算训练集中rows这些子图的描述子
+    # DDP时每个rank计算rows中连续的一段再all-gather，所有rank返回相同的[len(rows), D]
+    # DDP的forward会广播buffer，各rank的batch数不同时会卡住，直接用里面的模型
+    model = unwrap(model)
+    rows = shard(rows)
+    if load_fast:
+        load_fn = lambda s: TRAINING_POINT_CLOUD[rows[s]]
+    else:
+        load_fn = lambda s: load_pc_files(list(TRAINING_QUERIES.files[rows[s]]))
+    batch_num = args.eval_batch_size * (1 + args.positives_per_query + args.negatives_per_query)
+    if depth is None:
+        depth = args.prefetch_depth
+    model.eval()
+    # 后台线程预读下一批子图，和当前batch的前向计算重叠
+    q_output = embed(model, load_fn, len(rows), batch_num, device,
+                     depth=depth, num_threads=args.loader_threads, tqdm_flag=tqdm_flag)
+    model.train()
+    if len(rows) == 0:
+        q_output = q_output.reshape(0, cfg.FEATURE_OUTPUT_DIM)
+    q_output = all_gather_array(q_output)
+    return q_output
+
+
+def update_vectors(args, model, tqdm_flag=True, iteration=0, max_age=0):
+    # 重新计算训练集的TRAINING_LATENT_VECTORS
+    # max_age > 0且缓存已满时只重算最近max_age次迭代内没有计算过的行，其余行由最近的训练step（write_latents）或刷新写入
+    global TRAINING_LATENT_VECTORS, LATENT_ITERATION, REFRESH_CURSOR
     global TRAINING_QUERIES
 
     torch.cuda.empty_cache()
 
-    if tqdm_flag:
-        fun_tqdm = tqdm
+    if max_age > 0 and len(LATENT_ITERATION) == len(TRAINING_QUERIES):
+        rows = np.flatnonzero(latent_ages(iteration) >= max_age)
+        if len(rows) > 0:
+            TRAINING_LATENT_VECTORS[rows] = embed_rows(args, model, rows, tqdm_flag)
+            LATENT_ITERATION[rows] = iteration
     else:
-        fun_tqdm = list
-
-    train_file_idxs = np.arange(0, len(TRAINING_QUERIES.keys()))
+        rows = np.arange(len(TRAINING_QUERIES))
+        TRAINING_LATENT_VECTORS = embed_rows(args, model, rows, tqdm_flag)
+        LATENT_ITERATION = np.full(len(rows), iteration, dtype=np.int64)
+        REFRESH_CURSOR = 0
+    # log_string("Updated cached feature vectors")
+    torch.cuda.empty_cache()
+    if args.hard_neg_index == 'ivf':
+        build_latent_index(args, tqdm_flag)
+
+    log_string("update %d/%d vectors." % (len(rows), len(TRAINING_QUERIES)), print_flag=tqdm_flag)
+
+
+def refresh_vectors(args, model, iteration):
+    # 重新计算TRAINING_LATENT_VECTORS接下来的args.latent_refresh行，到末尾后从头开始
+    # 每个训练step调用，代替暂停训练的整体update_vectors，len(TRAINING_QUERIES) / latent_refresh步刷新一轮
+    global REFRESH_CURSOR
+    num = len(TRAINING_LATENT_VECTORS)
+    rows = (REFRESH_CURSOR + np.arange(min(args.latent_refresh, num))) % num
+    REFRESH_CURSOR = int(rows[-1] + 1) % num
+
+    TRAINING_LATENT_VECTORS[rows] = embed_rows(args, model, rows, depth=0)
+    LATENT_ITERATION[rows] = iteration
+    if LATENT_INDEX is not None:
+        if (rows == num - 1).any():
+            # 刷新完一轮（这一段经过最后一行）后重新划分IVF的桶
+            build_latent_index(args, tqdm_flag=False)
+        else:
+            LATENT_INDEX.update(rows, TRAINING_LATENT_VECTORS[rows])
 
-    batch_num = args.eval_batch_size * (1 + args.positives_per_query + args.negatives_per_query)
-    # log_string("\n args: ",args.batch_num_queries,args.positives_per_query,args.negatives_per_query)
-    q_output = []
 
-    model.eval()
+def write_latents(indices, output, iteration):
+    # 把一个训练step的描述子output [B,tuple_size,D]写回TRAINING_LATENT_VECTORS
+    # 它们来自train模式的前向（BatchNorm用batch统计量），与eval模式的描述子接近但不完全相同；DDP时收集所有rank的step，各rank的缓存保持一致
+    if len(TRAINING_LATENT_VECTORS) == 0:
+        return
+    rows = all_gather_array(np.asarray(indices).reshape(-1))
+    TRAINING_LATENT_VECTORS[rows] = all_gather_array(
+        output.detach().float().cpu().numpy().reshape(-1, TRAINING_LATENT_VECTORS.shape[1]))
+    LATENT_ITERATION[rows] = iteration
+    if LATENT_INDEX is not None:
+        LATENT_INDEX.update(rows, TRAINING_LATENT_VECTORS[rows])
 
-    for q_index in fun_tqdm(range(len(train_file_idxs) // batch_num)):
-    # for q_index in tqdm(range(batch_num*2 // batch_num)):
-        if load_fast:
-            file_indices = np.arange(q_index * batch_num, (q_index + 1) * (batch_num))
-            queries = TRAINING_POINT_CLOUD[file_indices]
-        else:
-            file_indices = train_file_idxs[q_index * batch_num:(q_index + 1) * (batch_num)]
-            file_names = []
-            for index in file_indices:
-                file_names.append(TRAINING_QUERIES[index]["query"])
-            queries = load_pc_files(file_names)
-
-        feed_tensor = torch.from_numpy(queries).float()
-        feed_tensor = feed_tensor.unsqueeze(1)
-        feed_tensor = feed_tensor.to(device)
-        with torch.no_grad():
-            out = model(feed_tensor)
-        out = out.detach().cpu().numpy()
-        out = np.squeeze(out)
-        q_output.append(out)
-
-    q_output = np.array(q_output)
-    if (len(q_output) != 0):
-        q_output = q_output.reshape(-1, q_output.shape[-1])
-
-    del feed_tensor
-
-    # handle edge case
-    for q_index in fun_tqdm(range((len(train_file_idxs) // batch_num * batch_num), len(TRAINING_QUERIES.keys()))):
-        if load_fast:
-            queries = TRAINING_POINT_CLOUD[train_file_idxs[q_index]]
-            queries = np.expand_dims(np.expand_dims(queries, axis=0), axis=0)
-        else:
-            index = train_file_idxs[q_index]
-            queries = load_pc_files([TRAINING_QUERIES[index]["query"]])
-
-        with torch.no_grad():
-            queries_tensor = torch.from_numpy(queries).float()
-            queries_tensor = queries_tensor.to(device)
-            output = model(queries_tensor)
-
-        output = output.detach().cpu().numpy()
-        output = np.squeeze(output)
-        if (q_output.shape[0] != 0):
-            q_output = np.vstack((q_output, output.reshape(-1,cfg.FEATURE_OUTPUT_DIM)))
-        else:
-            q_output = output
-    del queries_tensor
 
-    model.train()
+def latent_ages(iteration):
+    # 每一行描述子距上次计算经过的迭代数
+    return iteration - LATENT_ITERATION
 
-    TRAINING_LATENT_VECTORS = q_output
-    # log_string("Updated cached feature vectors")
-    torch.cuda.empty_cache()
 
-    if tqdm_flag:
-        log_string("update all vectors.")
-    else:
-        log_string("update all vectors.", print_flag=False)
\ No newline at end of file
+def build_latent_index(args, tqdm_flag=True, num_check=256):
+    # 重建LATENT_INDEX，并在抽样的query上记录它与精确搜索相比的耗时和召回
+    global LATENT_INDEX
+    start = time()
+    LATENT_INDEX = IVFIndex(TRAINING_LATENT_VECTORS)
+    build_ms = 1000 * (time() - start)
+    queries = TRAINING_LATENT_VECTORS[np.random.choice(len(TRAINING_LATENT_VECTORS),
+                                                       min(num_check, len(TRAINING_LATENT_VECTORS)), replace=False)]
+    check = compare_exact(LATENT_INDEX, queries, max(args.hard_neg_per_query, 1), args.ivf_nprobe)
+    log_string("ivf index build %.1f ms, search %.2f ms (exact %.2f ms) per %d queries, recall %.3f"
+               % (build_ms, check["ivf_ms"], check["exact_ms"], len(queries), check["recall"]), print_flag=tqdm_flag)
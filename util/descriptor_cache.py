@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import pickle
+import numpy as np
+import torch
+
+VECTORS_FILE = "descriptors.npy"
+INDEX_FILE = "files.pickle"
+
+
+def model_hash(model, extra=""):
+    # 权重的内容hash，同一个checkpoint对应同一个缓存；extra混入不改变权重但改变描述子的设置
+    # DataParallel会在参数名前加module.，统一去掉
+    model = getattr(model, "module", model)
+    h = hashlib.sha1()
+    for name, value in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        update_hash(h, value)
+    h.update(extra.encode())
+    return h.hexdigest()[:16]
+
+
+def update_hash(h, value):
+    # 动态量化层的state_dict里是(int8权重, bias)元组和dtype
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            update_hash(h, item)
+    elif torch.is_tensor(value):
+        if value.is_quantized:
+            value = value.dequantize()
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    elif value is not None:
+        h.update(str(value).encode())
+
+
+class DescriptorCache(object):
+    # 一个模型的描述子保存在<folder>/<model hash>/下：descriptors.npy每个子图一行，files.pickle为文件名到行号的映射
+    # 重叠的benchmark共用同一行
+    def __init__(self, folder, key):
+        self.folder = os.path.join(folder, key)
+        self.index = {}
+        self.vectors = None
+        self.dirty = False
+        if os.path.exists(os.path.join(self.folder, INDEX_FILE)):
+            with open(os.path.join(self.folder, INDEX_FILE), 'rb') as handle:
+                self.index = pickle.load(handle)
+            self.vectors = np.load(os.path.join(self.folder, VECTORS_FILE))
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, filenames):
+        # 返回缓存中的描述子（缺失的行为0）和缺失的mask
+        rows = np.array([self.index.get(filename, -1) for filename in filenames], dtype=np.int64)
+        missing = rows < 0
+        if self.vectors is None:
+            return None, missing
+        vectors = self.vectors[np.maximum(rows, 0)]
+        vectors[missing] = 0
+        return vectors, missing
+
+    def add(self, filenames, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(filenames), -1)
+        if self.vectors is None:
+            self.vectors = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+        start = len(self.vectors)
+        self.vectors = np.concatenate((self.vectors, vectors))
+        for i, filename in enumerate(filenames):
+            self.index[filename] = start + i
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        # 先写临时文件再替换，中断时不会留下不一致的缓存
+        tmp_vectors = os.path.join(self.folder, VECTORS_FILE + ".tmp.npy")
+        tmp_index = os.path.join(self.folder, INDEX_FILE + ".tmp")
+        np.save(tmp_vectors, self.vectors)
+        with open(tmp_index, 'wb') as handle:
+            pickle.dump(self.index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_vectors, os.path.join(self.folder, VECTORS_FILE))
+        os.replace(tmp_index, os.path.join(self.folder, INDEX_FILE))
+        self.dirty = False
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+from datetime import timedelta
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# rank 0评估时其他进程在barrier等待，默认30分钟的超时不够
+TIMEOUT = timedelta(hours=3)
+
+
+def init_distributed(args):
+    # 由torch.distributed.launch/torchrun启动时加入进程组，返回是否为分布式训练
+    # launcher给出--local_rank（--use_env和torchrun时为环境变量LOCAL_RANK）和WORLD_SIZE；后端默认gpu上nccl、cpu上gloo
+    if args.local_rank < 0 and "LOCAL_RANK" in os.environ:
+        args.local_rank = int(os.environ["LOCAL_RANK"])
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1 or not dist.is_available():
+        return False
+    backend = args.dist_backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    if torch.cuda.is_available():
+        # 之后的.cuda()和torch.device("cuda")都指向本进程的卡
+        torch.cuda.set_device(args.local_rank)
+    dist.init_process_group(backend=backend, init_method="env://", timeout=TIMEOUT)
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def unwrap(model):
+    # DataParallel/DistributedDataParallel外面的一层
+    return getattr(model, "module", model)
+
+
+def shard(rows):
+    # 本进程负责的连续一段，各rank的段按顺序拼起来就是rows
+    return np.array_split(rows, get_world_size())[get_rank()]
+
+
+def broadcast_object(obj, src=0):
+    # 把rank src上的obj发给所有rank，例如只有rank 0评估得到的recall
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_array(array):
+    # 各rank的array [n_rank, ...]按rank顺序沿第0维拼接，各rank的n_rank可以不同
+    if not is_distributed():
+        return array
+    array = np.ascontiguousarray(array)
+    # nccl只能收发gpu上的tensor
+    tensor_device = torch.device("cuda") if dist.get_backend() == "nccl" else torch.device("cpu")
+    size = torch.tensor([array.shape[0]], dtype=torch.int64, device=tensor_device)
+    sizes = [torch.zeros_like(size) for _ in range(get_world_size())]
+    dist.all_gather(sizes, size)
+    sizes = [int(s.item()) for s in sizes]
+    # all_gather要求各rank形状相同，补齐到最长的一段
+    padded = np.zeros((max(sizes),) + array.shape[1:], dtype=array.dtype)
+    padded[:array.shape[0]] = array
+    tensor = torch.from_numpy(padded).to(tensor_device)
+    gathered = [torch.empty_like(tensor) for _ in sizes]
+    dist.all_gather(gathered, tensor)
+    return np.concatenate([g[:s].cpu().numpy() for g, s in zip(gathered, sizes)])
+
+
+class NullWriter(object):
+    # rank 0以外的进程不写tensorboard，所有add_*都什么也不做
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
@@ -1,6 +1,9 @@
 import gc
 import datetime
-import pynvml
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
 import torch
 import numpy as np
@@ -50,6 +53,8 @@ class MemTracker(object):
         """
         Track the GPU memory usage
         """
+        if pynvml is None:
+            return
         pynvml.nvmlInit()
         handle = pynvml.nvmlDeviceGetHandleByIndex(self.device)
         meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
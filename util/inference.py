@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import numpy as np
+import torch
+from util.PointNetVlad import PointNetVlad
+from util.pipeline import embed
+from util.quantize import quantize_model
+
+# 只依赖模型定义，不导入initPara（argparse、日志目录、评估pickle），服务进程冷启动快
+# 与train_pointnetvlad.py的参数同名的模型配置
+MODEL_CONFIG = {
+    "num_points": 4096,
+    "featnet": "lpdnetorigin",
+    "emb_dims": 1024,
+    "fstn": False,
+    "xyzstn": False,
+    "spatial_knn": "dense",
+    "vlad_rank": 0,
+}
+# TorchScript文件中随模型保存的配置
+CONFIG_FILE = "config.json"
+
+
+def model_config(**kwargs):
+    config = dict(MODEL_CONFIG)
+    for key, value in kwargs.items():
+        if key not in config:
+            raise KeyError("unknown model option " + key)
+        config[key] = value
+    return config
+
+
+def build_model(config):
+    return PointNetVlad(num_points=config["num_points"], featnet=config["featnet"], emb_dims=config["emb_dims"],
+                        feature_transform=config["fstn"], xyz_trans=config["xyzstn"],
+                        spatial_knn=config["spatial_knn"], vlad_rank=config["vlad_rank"])
+
+
+def load_checkpoint(path, config, device="cpu"):
+    # 从.t7的state dict或训练保存的.ckpt得到eval模式的PointNetVlad
+    checkpoint = torch.load(path, map_location="cpu")
+    state_dict = checkpoint.get("state_dict", checkpoint)
+    # DataParallel保存的参数名带module.前缀
+    state_dict = {(key[7:] if key.startswith("module.") else key): value for key, value in state_dict.items()}
+    model = build_model(config)
+    model.load_state_dict(state_dict, strict=True)
+    return model.to(device).eval()
+
+
+def load_torchscript(path, device="cpu"):
+    # 返回模型和导出时保存的配置
+    extra_files = {CONFIG_FILE: ""}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    config = model_config(**json.loads(extra_files[CONFIG_FILE])) if extra_files[CONFIG_FILE] else model_config()
+    return model.eval(), config
+
+
+def export(model, config, torchscript_path="", onnx_path="", batch_size=2, opset_version=11):
+    # 在[batch_size,1,num_points,3]的输入上trace并保存TorchScript和/或ONNX
+    # ONNX中batch维是动态的，num_points由trace固定；配置保存在TorchScript文件里
+    model = model.eval()
+    device = next(model.parameters()).device
+    example = torch.rand(batch_size, 1, config["num_points"], 3, device=device)
+    with torch.no_grad():
+        if torchscript_path:
+            traced = torch.jit.trace(model, example)
+            torch.jit.save(traced, torchscript_path, _extra_files={CONFIG_FILE: json.dumps(config)})
+        if onnx_path:
+            torch.onnx.export(model, example, onnx_path, opset_version=opset_version,
+                              input_names=["points"], output_names=["descriptor"],
+                              dynamic_axes={"points": {0: "batch"}, "descriptor": {0: "batch"}})
+
+
+def read_bin(filename, num_points=4096):
+    # 数据集的.bin为float64的[num_points,3]
+    pc = np.fromfile(filename, dtype=np.float64)
+    if pc.shape[0] != num_points * 3:
+        raise ValueError("expected " + str(num_points) + " points in " + filename)
+    return pc.reshape(num_points, 3)
+
+
+class DescriptorExtractor(object):
+    # 子图（.bin路径或[num_points,3]数组）的全局描述子，包装eval模式的PointNetVlad或其TorchScript导出
+    # 当前batch计算时读取下一批.bin
+    def __init__(self, model, num_points=4096, batch_size=16, device="cpu", num_threads=0, loader_threads=2):
+        self.model = model
+        self.num_points = num_points
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.loader_threads = loader_threads
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+
+    @classmethod
+    def from_file(cls, path, config=None, int8=False, **kwargs):
+        # .pt为导出的TorchScript，其余当作训练保存的checkpoint；int8只支持checkpoint，在cpu上运行
+        device = kwargs.get("device", "cpu")
+        if os.path.splitext(path)[1] == ".pt":
+            model, config = load_torchscript(path, device)
+        else:
+            config = config if config is not None else model_config()
+            model = load_checkpoint(path, config, device)
+            if int8:
+                model, _ = quantize_model(model)
+                kwargs["device"] = "cpu"
+        return cls(model, num_points=config["num_points"], **kwargs)
+
+    def __call__(self, clouds):
+        # 返回[N, output_dim]的float32描述子，clouds为单个点云、序列或[N,num_points,3]数组
+        if isinstance(clouds, str) or (isinstance(clouds, np.ndarray) and clouds.ndim == 2):
+            clouds = [clouds]
+        load_fn = lambda s: np.stack([self.load(cloud) for cloud in clouds[s]])
+        return embed(self.model, load_fn, len(clouds), self.batch_size, self.device,
+                     depth=2 if self.loader_threads > 0 else 0, num_threads=self.loader_threads)
+
+    def load(self, cloud):
+        if isinstance(cloud, str):
+            return read_bin(cloud, self.num_points)
+        cloud = np.asarray(cloud)
+        if cloud.shape != (self.num_points, 3):
+            raise ValueError("expected a [" + str(self.num_points) + ", 3] cloud, got " + str(cloud.shape))
+        return cloud
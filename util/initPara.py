@@ -7,25 +7,51 @@ import torch
 import numpy as np
 import config as cfg
 import util.PointNetVlad as PNV
+import util.lpdnet_model as lpdnet_model
+from util.amp import AMP_DTYPES
+from util.distributed import init_distributed, get_rank, is_main_process, broadcast_object
 from dateutil import tz
-import pynvml
-
-pynvml.nvmlInit()
-handle0 = pynvml.nvmlDeviceGetHandleByIndex(0)
-if torch.cuda.device_count() > 1:
-    handle1 = pynvml.nvmlDeviceGetHandleByIndex(1)
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+# 只在有NVIDIA驱动时统计显存，CPU机器上print_gpu什么也不做
+handle0 = None
+if pynvml is not None and torch.cuda.is_available():
+    try:
+        pynvml.nvmlInit()
+        handle0 = pynvml.nvmlDeviceGetHandleByIndex(0)
+        if torch.cuda.device_count() > 1:
+            handle1 = pynvml.nvmlDeviceGetHandleByIndex(1)
+    except pynvml.NVMLError:
+        handle0 = None
 ratio = 1024 ** 2
 
 def print_gpu(s=""):
+    if handle0 is None:
+        return
     if torch.cuda.device_count() > 1:
         meminfo0 = pynvml.nvmlDeviceGetMemoryInfo(handle0)
-        meminfo1 = pynvml.nvmlDeviceGetMemoryInfo(handle0)
+        meminfo1 = pynvml.nvmlDeviceGetMemoryInfo(handle1)
         used = (meminfo0.used + meminfo1.used) / ratio
     else:
         meminfo0 = pynvml.nvmlDeviceGetMemoryInfo(handle0)
         used = meminfo0.used / ratio
     print(s+" used: ", used)
 
+
+def peak_memory():
+    # 返回峰值内存(MB)及其范围：gpu上为自上次调用以来pytorch分配的显存（多卡取最大）
+    # cpu上最大常驻内存无法重置，为整个进程到目前为止的峰值
+    if torch.cuda.is_available():
+        peak = max(torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count()))
+        for i in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(i)
+        return peak / ratio, "since last report"
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "process"
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--results_dir', default='results/',
                     help='results dir [default: results]')
@@ -56,7 +82,8 @@ parser.add_argument('--margin_1', type=float, default=0.5,
 parser.add_argument('--margin_2', type=float, default=0.2,
                     help='Margin for hinge loss [default: 0.2]')
 parser.add_argument('--loss_function', default='quadruplet', choices=[
-    'triplet', 'quadruplet'], help='triplet or quadruplet [default: quadruplet]')
+    'triplet', 'quadruplet', 'in_batch_hard', 'in_batch_weighted'],
+    help='triplet, quadruplet, or triplet over every cloud of the batch: hardest negative / distance-weighted [default: quadruplet]')
 parser.add_argument('--loss_lazy', action='store_false',default=True,
                     help='If present, do not use lazy variant of loss')
 parser.add_argument('--triplet_use_best_positives', action='store_false',default=True,
@@ -69,6 +96,14 @@ parser.add_argument('--resume', action='store_true',
                     help='If present, restore checkpoint and resume training')
 parser.add_argument('--dataset_folder', default='./benchmark_datasets/',
                     help='PointNetVlad Dataset Folder')
+parser.add_argument('--num_threads', type=int, default=0,
+                    help='Intra-op threads of torch on CPU [default: 0, torch default]')
+parser.add_argument('--prefetch_depth', type=int, default=2,
+                    help='Batches read ahead while embedding submaps, 0 to load synchronously [default: 2]')
+parser.add_argument('--loader_threads', type=int, default=2,
+                    help='Threads reading submaps for the prefetch pipeline [default: 2]')
+parser.add_argument('--pc_store', default='',
+                    help='Packed float32 submap store built by generating_queries/generate_pc_store.py')
 parser.add_argument('--pretrained_path', type=str, default='', metavar='N',
                     help='Pretrained model path')
 parser.add_argument('--featnet', type=str, default='lpdnetorigin', metavar='N',
@@ -80,26 +115,70 @@ parser.add_argument('--xyzstn', action='store_true', default=False,
 parser.add_argument('--lr', type=float, default=0.001, metavar='LR',
                         help='learning rate (min: 0.00001, 0.1 if using sgd)')
 parser.add_argument('--emb_dims', type=int, default=1024)
+parser.add_argument('--spatial_knn', default='dense', choices=['dense', 'grid'],
+                    help='knn of the spatial neighborhood fusion on xyz: dense distance matrix or voxel grid [default: dense]')
+parser.add_argument('--vlad_rank', type=int, default=0,
+                    help='Rank of the factorized NetVLAD hidden weights, full checkpoints are converted by SVD on load [default: 0, full]')
+parser.add_argument('--latent_refresh', type=int, default=0,
+                    help='Training submaps re-embedded every step instead of pausing to re-embed all of them [default: 0, full refresh]')
+parser.add_argument('--latent_writeback', action='store_true', default=False,
+                    help='If present, write the descriptors of every training step back to the hard negative cache')
+parser.add_argument('--latent_max_age', type=int, default=-1,
+                    help='Scheduled refreshes only re-embed cache entries older than this many iterations, 0 re-embeds all '
+                         '[default: one refresh interval with --latent_writeback, otherwise 0]')
+parser.add_argument('--hard_neg_index', default='sampled', choices=['sampled', 'ivf'],
+                    help='Hard negatives from 4000 random negatives per query, or from an IVF index over all training latents [default: sampled]')
+parser.add_argument('--ivf_nprobe', type=int, default=8,
+                    help='Inverted lists scanned per query with --hard_neg_index=ivf [default: 8]')
+parser.add_argument('--amp', default='off', choices=['off', 'bf16', 'fp16'],
+                    help='Mixed precision of the forward pass in training and evaluation, knn stays fp32; fp16 only on gpu [default: off]')
+parser.add_argument('--amp_benchmark', action='store_true', default=False,
+                    help='If present, compare activation memory and throughput of --amp against fp32 on one training batch and exit')
+parser.add_argument('--grad_checkpoint', action='store_true', default=False,
+                    help='If present, recompute the DG/SN neighborhood blocks of lpdnet in backward instead of storing their activations')
+parser.add_argument('--knn_mem_budget', type=int, default=256,
+                    help='MB of pairwise distances knn keeps at once, larger clouds are split into blocks [default: 256]')
 parser.add_argument('--eval', action='store_true', default=False,
                         help='evaluate the model')
+parser.add_argument('--eval_benchmarks', nargs='*', default=[],
+                    help='With --eval, benchmarks evaluated in one pass, e.g. oxford university residential business')
+parser.add_argument('--quantize', action='store_true', default=False,
+                    help='With --eval, also evaluate a dynamic int8 CPU model and report the recall drop against fp32')
+parser.add_argument('--quant_calib', type=int, default=64,
+                    help='Training submaps used to measure the per-layer int8 error [default: 64]')
+parser.add_argument('--quant_tol', type=float, default=0.01,
+                    help='Keep a layer in fp32 if int8 lowers the descriptor cosine similarity by more than this, 0 quantizes all [default: 0.01]')
+parser.add_argument('--desc_cache', default='',
+                    help='Folder caching evaluation descriptors per checkpoint hash [default: off]')
+parser.add_argument('--eval_workers', type=int, default=0,
+                    help='Processes computing recall, one database per task [default: 0, in process]')
 parser.add_argument('--log_dir', default='checkpoints/', help='Log dir [default: log]')
 parser.add_argument('--seed', type=int, default=1234, metavar='S',
                         help='random seed (default: 1)')
 parser.add_argument('--local_rank', default=-1, type=int,help='node rank for distributed training')
+parser.add_argument('--dist_backend', default='', choices=['', 'nccl', 'gloo'],
+                    help='Backend of DistributedDataParallel training [default: nccl on gpu, gloo on cpu]')
 
 args = parser.parse_args()
 
+# torch.distributed.launch启动的每个进程加入进程组，单进程时什么也不做
+args.distributed = init_distributed(args)
 # 初始化使用的后端
-torch.manual_seed(args.seed)
-torch.cuda.manual_seed_all(args.seed)
-np.random.seed(args.seed)
+# 模型参数由DDP从rank 0广播；DataLoader worker的numpy种子来自torch的随机数，
+# 所以torch和numpy都要按rank错开，各rank才会采样不同的元组
+torch.manual_seed(args.seed + get_rank())
+torch.cuda.manual_seed_all(args.seed + get_rank())
+np.random.seed(args.seed + get_rank())
+if args.num_threads > 0:
+    torch.set_num_threads(args.num_threads)
 
 torch.backends.cudnn.benchmark = True
 torch.backends.cudnn.deterministic = True
 
 cfg.DATASET_FOLDER = args.dataset_folder
-if not os.path.exists(args.log_dir):
-    os.mkdir(args.log_dir)
+cfg.PC_STORE_FOLDER = args.pc_store
+lpdnet_model.knn_mem_budget = args.knn_mem_budget * 1024 ** 2
+os.makedirs(args.log_dir, exist_ok=True)
 
 if args.eval:
     file = args.pretrained_path
@@ -110,23 +189,21 @@ if args.eval:
 else:
     tz_sh = tz.gettz('Asia/Shanghai')
     args.exp_name = args.featnet + '-' + datetime.now(tz=tz_sh).strftime("%d-%H-%M-%S")
-if not os.path.exists('checkpoints'):
-    os.makedirs('checkpoints')
-if not os.path.exists('checkpoints/' + args.exp_name):
-    os.makedirs('checkpoints/' + args.exp_name)
-if not os.path.exists('checkpoints/' + args.exp_name + '/' + 'models'):
-    os.makedirs('checkpoints/' + args.exp_name + '/' + 'models')
+# 所有rank使用rank 0的实验目录
+args.exp_name = broadcast_object(args.exp_name)
+os.makedirs('checkpoints/' + args.exp_name + '/' + 'models', exist_ok=True)
 args.model_save_path = 'checkpoints/' + args.exp_name + '/' + 'models'
 args.log_dir = 'checkpoints/' + args.exp_name
 cfg.RESULTS_FOLDER = args.log_dir + '/' + cfg.RESULTS_FOLDER
-if not os.path.exists(cfg.RESULTS_FOLDER):
-    os.makedirs(cfg.RESULTS_FOLDER)
+os.makedirs(cfg.RESULTS_FOLDER, exist_ok=True)
 
-LOG_FOUT = open(os.path.join(args.log_dir, 'log_train.txt'), 'w')
+# 其他rank写各自的日志，只有rank 0打印
+LOG_FOUT = open(os.path.join(args.log_dir, 'log_train.txt' if is_main_process() else
+                             'log_train_rank%d.txt' % get_rank()), 'w')
 def log_string(out_str, print_flag = True):
     LOG_FOUT.write(out_str + '\n')
     LOG_FOUT.flush()
-    if print_flag:
+    if print_flag and is_main_process():
         print(out_str)
 
 log_string(str(args), print_flag=False)
@@ -135,7 +212,8 @@ if args.featnet=="lpdnet":
 elif args.featnet=="pointnet":
     print("use pointnet")
 model = PNV.PointNetVlad(feature_transform=args.fstn, num_points=args.num_points, featnet=args.featnet,
-                         emb_dims=args.emb_dims,xyz_trans=args.xyzstn)
+                         emb_dims=args.emb_dims,xyz_trans=args.xyzstn, spatial_knn=args.spatial_knn, vlad_rank=args.vlad_rank,
+                         grad_checkpoint=args.grad_checkpoint)
 para = sum([np.prod(list(p.size())) for p in model.parameters()])
 # 下面的type_size是4，因为我们的参数是float32也就是4B，4个字节
 print(str("Model {} : params: {:4f}M".format(model._get_name(), para * 4 / 1000 / 1000)))
@@ -143,6 +221,8 @@ print(str("Model {} : params: {:4f}M".format(model._get_name(), para * 4 / 1000
 # 知乎说会节省显存，没啥用
 # model.apply(inplace_relu)
 
+model.amp_dtype = AMP_DTYPES[args.amp]
+
 if torch.cuda.is_available():
     model = model.cuda()
     log_string("use cuda!")
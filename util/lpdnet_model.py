@@ -7,16 +7,19 @@ import numpy as np
 from tqdm import tqdm
 import gc
 import os
-from util.gpu_mem_track import MemTracker
+import functools
 import inspect
-
-frame = inspect.currentframe()  # define a frame to track
-gpu_tracker = MemTracker(frame)  # define a GPU tracker
+from torch.utils.checkpoint import checkpoint
+from util.amp import autocast_off
 
 # 探究领域特征应该拼接还是stack
 cat_or_stack = True  # true表示cat
 class LPDNetOrign(nn.Module):
-    def __init__(self, emb_dims=512, use_mFea=False, t3d=True, tfea=False, use_relu=False):
+    # 通过edge_conv直接使用卷积权重的层，不能替换成其他模块
+    edge_convs = ("convDG1",)
+
+    def __init__(self, emb_dims=512, use_mFea=False, t3d=True, tfea=False, use_relu=False, spatial_knn="dense",
+                 grad_checkpoint=False):
         super(LPDNetOrign, self).__init__()
         self.negative_slope = 1e-2
         if use_relu:
@@ -29,6 +32,10 @@ class LPDNetOrign(nn.Module):
         else:
             initFeaNum = 3
         self.k = 20
+        # 空间邻域融合的knn：dense为稠密距离矩阵，grid为体素网格搜索
+        self.spatial_knn = spatial_knn
+        # 训练时不保存DG/SN邻域块的中间结果，反向时重新计算
+        self.grad_checkpoint = grad_checkpoint
         self.t3d = t3d
         self.tfea = tfea
         self.emb_dims = emb_dims
@@ -94,17 +101,14 @@ class LPDNetOrign(nn.Module):
 
         # Serial structure
         # Danymic Graph cnn for feature space
-        x = get_graph_feature_Origin(x, k=self.k)  # [b,64*2,num,20]
-        x = self.convDG1(x)  # [b,64,num,20]
-        x = self.convDG2(x)  # [b,64,num,20]
-        x = x.max(dim=-1, keepdim=True)[0]  # [b,64,num,1]
+        x = checkpoint_block(self.grad_checkpoint, self.dg_block, x)  # [b,64,num,1]
 
         # Spatial Neighborhood fusion for cartesian space
-        idx = knn(xInit3d, k=self.k)
-        x = get_graph_feature_Origin(x, idx=idx, k=self.k, cat=False)  # [b,64,num,20]
-        x = self.convSN1(x)  # [b,64,num,20]
-        x = self.convSN2(x)  # [b,64,num,20]
-        x = x.max(dim=-1, keepdim=True)[0].squeeze(-1)  # [b,64,num]
+        if self.spatial_knn == "grid":
+            idx = grid_knn(xInit3d, k=self.k)
+        else:
+            idx = knn(xInit3d, k=self.k)
+        x = checkpoint_block(self.grad_checkpoint, self.sn_block, x, idx)  # [b,64,num]
 
         x = self.conv3_lpd(x)  # [b,64,num]
         x = self.conv4_lpd(x)  # [b,128,num]
@@ -113,6 +117,34 @@ class LPDNetOrign(nn.Module):
 
         return x
 
+    # input x [b,64,num]
+    # output [b,64,num,1]
+    def dg_block(self, x):
+        x = edge_conv_Origin(x, self.convDG1, k=self.k)  # [b,64,num,20]
+        x = self.convDG2(x)  # [b,64,num,20]
+        return x.max(dim=-1, keepdim=True)[0]  # [b,64,num,1]
+
+    # input x [b,64,num,1], idx [b,num,20]
+    # output [b,64,num]
+    def sn_block(self, x, idx):
+        x = get_graph_feature_Origin(x, idx=idx, k=self.k, cat=False)  # [b,64,num,20]
+        x = self.convSN1(x)  # [b,64,num,20]
+        x = self.convSN2(x)  # [b,64,num,20]
+        return x.max(dim=-1, keepdim=True)[0].squeeze(-1)  # [b,64,num]
+
+
+# use_reentrant=False支持不需要梯度的输入(knn的idx)，旧版本torch没有这个参数
+CHECKPOINT_KWARGS = {"use_reentrant": False} if "use_reentrant" in inspect.signature(checkpoint).parameters else {}
+
+
+def checkpoint_block(enabled, block, *inputs):
+    # enabled时block(*inputs)在backward中重新计算而不保存激活
+    # block中的BatchNorm在训练时会看到两次同一个batch，running统计量更新得稍快
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(block, *inputs, **CHECKPOINT_KWARGS)
+    return block(*inputs)
+
+
 def get_graph_feature_Origin(x, k=20, idx=None, cat = True):
     batch_size = x.size(0)
     num_points = x.size(2)
@@ -120,7 +152,7 @@ def get_graph_feature_Origin(x, k=20, idx=None, cat = True):
     if idx is None:
         idx = knn(x, k=k)  # (batch_size, num_points, k)
 
-    device = torch.device('cuda')
+    device = x.device
     # 获得索引阶梯数组
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1,
                                                                1) * num_points  # (batch_size, 1, 1) [0 num_points ... num_points*(B-1)]
@@ -144,8 +176,47 @@ def get_graph_feature_Origin(x, k=20, idx=None, cat = True):
         feature = feature.permute(0, 3, 1, 2)
     return feature
 
+# input x [B,num_dims,num]，conv为Sequential(Conv2d 1x1, [BN], act)
+# output [B, out_dims, num, k]
+def edge_conv_Origin(x, conv, k=20, idx=None):
+    # 与conv(get_graph_feature_Origin(x, k, idx))输出相同
+    # (x, feature - x)上的1x1卷积拆成中心点和邻居两部分权重，在gather之前作用在点上，不生成[B,num_dims*2,num,k]的边特征
+    weight = conv[0].weight.flatten(1)  # [out,num_dims*2]
+    w_center, w_neighbor = weight.chunk(2, dim=1)
+    # Wc*x + Wn*(f-x) = (Wc-Wn)*x + Wn*f
+    return _edge_conv(x, conv, w_center - w_neighbor, w_neighbor, k, idx)
+
+
+# input x [B,num_dims,num]，conv为Sequential(Conv2d 1x1, [BN], act)
+# output [B, out_dims, num, k]
+def edge_conv(x, conv, k=20, idx=None):
+    # cat_or_stack为真时与conv(get_graph_feature(x, k, idx))输出相同
+    weight = conv[0].weight.flatten(1)  # [out,num_dims*2]
+    w_neighbor, w_center = weight.chunk(2, dim=1)
+    return _edge_conv(x, conv, w_center, w_neighbor, k, idx)
+
+
+def _edge_conv(x, conv, w_center, w_neighbor, k, idx):
+    batch_size, _, num_points = x.size()
+    if idx is None:
+        idx = knn(x, k=k)  # (batch_size, num_points, k)
+    center = torch.matmul(w_center, x)  # [B,out,num]
+    neighbor = torch.matmul(w_neighbor, x)  # [B,out,num]
+    out_dims = neighbor.size(1)
+    # 直接在投影后的特征上取邻域，用广播加上中心点，不再repeat k次
+    idx = idx.reshape(batch_size, 1, num_points * k).expand(-1, out_dims, -1)
+    feature = neighbor.gather(2, idx).view(batch_size, out_dims, num_points, k)  # [B,out,num,k]
+    feature = feature + center.unsqueeze(-1)
+    if conv[0].bias is not None:
+        feature = feature + conv[0].bias.view(1, -1, 1, 1)
+    return conv[1:](feature)
+
+
 class LPDNet(nn.Module):
-    def __init__(self, emb_dims=512, use_mFea=False, t3d=True, tfea=False, use_relu=False):
+    edge_convs = ("convDG1", "convSN1") if cat_or_stack else ()
+
+    def __init__(self, emb_dims=512, use_mFea=False, t3d=True, tfea=False, use_relu=False, spatial_knn="dense",
+                 grad_checkpoint=False):
         super(LPDNet, self).__init__()
         self.negative_slope = 1e-2
         if use_relu:
@@ -154,6 +225,10 @@ class LPDNet(nn.Module):
             self.act_f = nn.LeakyReLU(negative_slope=self.negative_slope, inplace=True)
         self.use_mFea = use_mFea
         self.k = 20
+        # 空间邻域融合的knn：dense为稠密距离矩阵，grid为体素网格搜索
+        self.spatial_knn = spatial_knn
+        # 训练时不保存DG/SN邻域块的中间结果，反向时重新计算
+        self.grad_checkpoint = grad_checkpoint
         self.t3d = t3d
         self.tfea = tfea
         self.emb_dims = emb_dims
@@ -242,20 +317,14 @@ class LPDNet(nn.Module):
 
         # Serial structure
         # Danymic Graph cnn for feature space
-        if cat_or_stack:
-            x = get_graph_feature(x, k=self.k)  # [b,64*2,num,20]
-        else:
-            x = get_graph_feature(x, k=self.k)  # [B, num_dims, num, k+1]
-        x = self.convDG1(x)  # [b,128,num,20]
-        x1 = x.max(dim=-1, keepdim=True)[0]  # [b,128,num,1]
-        x = self.convDG2(x)  # [b,128,num,20]
-        x2 = x.max(dim=-1, keepdim=True)[0]  # [b,128,num,1]
+        x1, x2 = checkpoint_block(self.grad_checkpoint, self.dg_block, x)  # [b,128,num,1] x2
 
         # Spatial Neighborhood fusion for cartesian space
-        idx = knn(xInit3d, k=self.k)
-        x = get_graph_feature(x2, idx=idx, k=self.k)  # [b,128*2,num,20]
-        x = self.convSN1(x)  # [b,256,num,20]
-        x3 = x.max(dim=-1, keepdim=True)[0]  # [b,256,num,1]
+        if self.spatial_knn == "grid":
+            idx = grid_knn(xInit3d, k=self.k)
+        else:
+            idx = knn(xInit3d, k=self.k)
+        x3 = checkpoint_block(self.grad_checkpoint, self.sn_block, x2, idx)  # [b,256,num,1]
 
         x = torch.cat((x1, x2, x3), dim=1).squeeze(-1)  # [b,512,num]
         if self.useBN:
@@ -267,6 +336,29 @@ class LPDNet(nn.Module):
         # [b,emb_dims,num,1]
         return x
 
+    # input x [b,64,num]
+    # output x1, x2 [b,128,num,1]
+    def dg_block(self, x):
+        if cat_or_stack:
+            x = edge_conv(x, self.convDG1, k=self.k)  # [b,128,num,20]
+        else:
+            x = get_graph_feature(x, k=self.k)  # [B, num_dims, num, k+1]
+            x = self.convDG1(x)  # [b,128,num,20]
+        x1 = x.max(dim=-1, keepdim=True)[0]  # [b,128,num,1]
+        x = self.convDG2(x)  # [b,128,num,20]
+        x2 = x.max(dim=-1, keepdim=True)[0]  # [b,128,num,1]
+        return x1, x2
+
+    # input x2 [b,128,num,1], idx [b,num,20]
+    # output [b,256,num,1]
+    def sn_block(self, x2, idx):
+        if cat_or_stack:
+            x = edge_conv(x2.squeeze(-1), self.convSN1, idx=idx, k=self.k)  # [b,256,num,20]
+        else:
+            x = get_graph_feature(x2, idx=idx, k=self.k)  # [b,128,num,k+1]
+            x = self.convSN1(x)  # [b,256,num,20]
+        return x.max(dim=-1, keepdim=True)[0]  # [b,256,num,1]
+
 
 # TranformNet
 # input x [B,num_dims,num]
@@ -304,25 +396,125 @@ class TranformNet(nn.Module):
         x = F.relu(self.bn5(self.fc2(x)), inplace=True)
         x = self.fc3(x)
 
-        device = torch.device('cuda')
-
-        iden = torch.eye(self.k, dtype=torch.float32, device=device).view(1, self.k * self.k).repeat(batchsize, 1)
+        iden = torch.eye(self.k, dtype=x.dtype, device=x.device).view(1, self.k * self.k).repeat(batchsize, 1)
 
         x = x + iden
         x = x.view(-1, self.k, self.k)
         return x
 
 
+# knn中距离矩阵的显存/内存上限（字节），超过时按query点分块计算
+knn_mem_budget = 256 * 1024 ** 2
+
+
+def fp32_distances(fn):
+    # 半精度的距离展开式-2xy+x^2+y^2误差大，邻居会选错，混合精度下knn仍用fp32计算
+    @functools.wraps(fn)
+    def wrapper(x, *args, **kwargs):
+        with autocast_off(x.device.type):
+            return fn(x.float(), *args, **kwargs)
+    return wrapper
+
+
 # input  [b,3,num]
-def knn(x, k):
-    inner = -2 * torch.matmul(x.transpose(2, 1).contiguous(), x)  # [b,num,num]
+@fp32_distances
+def knn(x, k, mem_budget=None):
+    if mem_budget is None:
+        mem_budget = knn_mem_budget
+    batch_size, _, num_points = x.size()
+    # 每个query点需要inner和pairwise_distance两行[b,num]
+    row_bytes = 2 * batch_size * num_points * x.element_size()
+    chunk = max(1, int(mem_budget // row_bytes))
     # 求坐标（维度空间）的平方和
     xx = torch.sum(x ** 2, dim=1, keepdim=True)  # [b,1,num] #x ** 2 表示点平方而不是x*x
-    # 2x1x2+2y1y2+2z1z2-x1^2-y1^2-z1^2-x2^2-y2^2-z2^2=-[(x1-x2)^2+(y1-y2)^2+(z1-z2)^2]
-    pairwise_distance = -xx - inner
-    del inner, x
-    pairwise_distance = pairwise_distance - xx.transpose(2, 1)  # [b,num,num]
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]  # (batch_size, num_points, k)
+    xt = x.transpose(2, 1).contiguous()  # [b,num,3]
+    idx = []
+    for start in range(0, num_points, chunk):
+        end = min(start + chunk, num_points)
+        inner = -2 * torch.matmul(xt[:, start:end], x)  # [b,chunk,num]
+        # 2x1x2+2y1y2+2z1z2-x1^2-y1^2-z1^2-x2^2-y2^2-z2^2=-[(x1-x2)^2+(y1-y2)^2+(z1-z2)^2]
+        pairwise_distance = -xx - inner
+        del inner
+        pairwise_distance = pairwise_distance - xx.transpose(2, 1)[:, start:end]  # [b,chunk,num]
+        idx.append(pairwise_distance.topk(k=k, dim=-1)[1])  # (batch_size, chunk, k)
+        del pairwise_distance
+    if len(idx) == 1:
+        return idx[0]
+    return torch.cat(idx, dim=1)  # (batch_size, num_points, k)
+
+
+# grid_knn估计体素大小时采样的点数
+grid_knn_samples = 64
+
+# 相邻的3x3个体素列，每列在z方向上连续3个体素
+GRID_OFFSETS = torch.tensor([[dx, dy, -1] for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+
+
+# input  [b,3,num]，只用于三维坐标
+@fp32_distances
+def grid_knn(x, k, cell_size=None, max_candidates=None):
+    # 与knn结果相同，只在每个点周围的27个体素中搜索
+    # 点按体素排序，每个z列的3个体素是searchsorted得到的一段连续区间
+    # 第k个邻居比cell_size近（27个体素以外不可能更近）且候选不超过max_candidates的行才采用，其余行走稠密的knn
+    batch_size, _, num_points = x.size()
+    if max_candidates is None:
+        max_candidates = 32 * k
+    pts = x.transpose(2, 1).contiguous()  # [b,num,3]
+    lo = pts.min(dim=1, keepdim=True)[0]  # [b,1,3]
+    xx = (pts ** 2).sum(dim=-1)  # [b,num]
+    if cell_size is None:
+        # 用少量采样点的k近邻距离估计体素大小，点集中在地面/墙面上时包围盒密度不准
+        sample = pts[:, ::max(1, num_points // grid_knn_samples)]  # [b,s,3]
+        inner = -2 * torch.matmul(sample, x)  # [b,s,num]
+        pairwise_distance = -xx.unsqueeze(1) - inner - (sample ** 2).sum(dim=-1, keepdim=True)
+        kth = -pairwise_distance.topk(k=k, dim=-1)[0][..., -1]  # [b,s]
+        cell_size = kth.clamp(min=1e-12).sqrt().quantile(0.9, dim=-1).clamp(min=1e-6).view(-1, 1, 1)
+    else:
+        cell_size = torch.full((batch_size, 1, 1), float(cell_size), device=x.device, dtype=x.dtype)
+    # 坐标整体加1，相邻体素的编号不会小于0
+    cell = ((pts - lo) / cell_size).floor().long() + 1  # [b,num,3]
+    dims = cell.view(-1, 3).max(dim=0)[0] + 2
+    batch = torch.arange(batch_size, device=x.device).view(-1, 1, 1)
+
+    def voxel_key(c):
+        return ((batch * dims[0] + c[..., 0]) * dims[1] + c[..., 1]) * dims[2] + c[..., 2]
+
+    keys = voxel_key(cell.unsqueeze(2)).view(-1)  # [b*num]
+    sorted_keys, order = keys.sort()
+    column_keys = voxel_key(cell.unsqueeze(2) + GRID_OFFSETS.to(x.device))  # [b,num,9]
+    start = torch.searchsorted(sorted_keys, column_keys)
+    count = torch.searchsorted(sorted_keys, column_keys + 2, right=True) - start
+    # 把9段区间首尾相接，每行补齐到相同长度
+    total = count.sum(dim=-1)  # [b,num]
+    width = int(min(total.max().item(), max_candidates))
+    if width < k:
+        return knn(x, k)
+    end = count.cumsum(dim=-1)  # [b,num,9]
+    slot = torch.arange(width, device=x.device).expand(batch_size, num_points, width)
+    column = torch.searchsorted(end, slot.contiguous(), right=True).clamp(max=8)
+    position = start.gather(-1, column) + slot - (end - count).gather(-1, column)
+    valid = slot < total.unsqueeze(-1)
+    candidate = order[position.clamp(min=0, max=keys.numel() - 1)]  # 所有batch展开后的点序号
+    # 与knn相同的距离展开式
+    inner = -2 * (pts.view(-1, 3)[candidate] * pts.unsqueeze(2)).sum(dim=-1)
+    pairwise_distance = -xx.view(-1)[candidate] - inner
+    del inner
+    pairwise_distance = pairwise_distance - xx.unsqueeze(-1)
+    pairwise_distance = pairwise_distance.masked_fill(~valid, float('-inf'))
+    value, pick = pairwise_distance.topk(k=k, dim=-1)
+    idx = candidate.gather(-1, pick) - batch * num_points  # (batch_size, num_points, k)
+
+    uncertain = (total > max_candidates) | (-value[..., -1] > cell_size.view(-1, 1) ** 2)
+    # 不确定的行用稠密knn重新计算
+    chunk = max(1, int(knn_mem_budget // (2 * num_points * x.element_size())))
+    for b in torch.nonzero(uncertain.any(dim=1)).view(-1).tolist():
+        rows = torch.nonzero(uncertain[b]).view(-1)
+        for begin in range(0, len(rows), chunk):
+            block = rows[begin:begin + chunk]
+            inner = -2 * torch.matmul(pts[b, block], x[b])  # [chunk,num]
+            pairwise_distance = -xx[b].unsqueeze(0) - inner
+            pairwise_distance = pairwise_distance - xx[b, block].unsqueeze(-1)
+            idx[b, block] = pairwise_distance.topk(k=k, dim=-1)[1]
     return idx
 
 
@@ -335,7 +527,7 @@ def get_graph_feature(x, k=20, idx=None):
     if idx is None:
         idx = knn(x, k=k)  # (batch_size, num_points, k)
 
-    device = torch.device('cuda')
+    device = x.device
     # 获得索引阶梯数组
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1,
                                                                1) * num_points  # (batch_size, 1, 1) [0 num_points ... num_points*(B-1)]
@@ -406,7 +598,7 @@ class LPD(nn.Module):
         # 每k个找到nk个最远的
         idx = pairwise_distance.topk(k=nk, dim=-1)[1]  # (batch_size, k, nk)
         # 获得索引阶梯数组
-        idx_base = torch.arange(0, batch_size, device=torch.device('cuda')).view(-1, 1,
+        idx_base = torch.arange(0, batch_size, device=src.device).view(-1, 1,
                                                                                  1) * k  # (batch_size, 1, 1) [0 k ... k*(B-1)]
         # 以batch为单位，加到索引上
         idx = idx + idx_base  # (batch_size, k, nk)
@@ -430,7 +622,7 @@ class LPD(nn.Module):
         tgt_embedding = tgt_embedding.transpose(2, 1).contiguous()
         src_length = torch.norm(src_embedding, dim=-1)
         tgt_length = torch.norm(tgt_embedding, dim=-1)
-        identity = torch.empty((batch_size, num_points), device=torch.device('cuda')).fill_(1)
+        identity = torch.empty((batch_size, num_points), device=src.device).fill_(1)
         loss_norm1 = torch.sqrt(F.mse_loss(src_length, identity))
         loss_norm2 = torch.sqrt(F.mse_loss(tgt_length, identity))
 
@@ -447,11 +639,12 @@ def test_one_epoch(args, net, test_loader):
     total_loss = 0
     num_examples = 0
 
+    device = next(net.parameters()).device
     with torch.no_grad():
         for src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba, label in tqdm(
                 test_loader):
-            src = src.cuda()
-            target = target.cuda()
+            src = src.to(device)
+            target = target.to(device)
             batch_size = src.size(0)
             num_examples += batch_size
             # [b, emb_dims, num]
@@ -472,10 +665,11 @@ def train_one_epoch(args, net, train_loader, opt):
     total_loss = 0
     num_examples = 0
 
+    device = next(net.parameters()).device
     for src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba, label in tqdm(
             train_loader):
-        src = src.cuda()
-        target = target.cuda()
+        src = src.to(device)
+        target = target.to(device)
         batch_size = src.size(0)
         opt.zero_grad()
         num_examples += batch_size
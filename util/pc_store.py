@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import numpy as np
+
+# 打包后的子图仓库：一个连续的float32文件 + 文件名到行号的索引
+POINTS_FILE = "points.npy"
+INDEX_FILE = "index.pickle"
+
+
+class PointCloudStore(object):
+    # 打包好的float32子图，mmap只读打开：points.npy为[N,num_points,3]，index.pickle为文件名到行号的映射
+    # 通过page cache共享，fork出的DataLoader worker不会各自复制一份
+    def __init__(self, folder):
+        self.folder = folder
+        self.points = np.load(os.path.join(folder, POINTS_FILE), mmap_mode='r')
+        with open(os.path.join(folder, INDEX_FILE), 'rb') as handle:
+            self.index = pickle.load(handle)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def get(self, filename):
+        # 只读视图，不拷贝
+        row = self.index.get(filename)
+        if row is None:
+            return None
+        return self.points[row]
+
+    def get_many(self, filenames):
+        # 一次fancy index取出整个batch，有缺失则返回None交给调用者回退
+        rows = [self.index.get(filename) for filename in filenames]
+        if any(row is None for row in rows):
+            return None
+        return self.points[np.asarray(rows, dtype=np.int64)]
+
+
+def build_store(dataset_folder, filenames, folder, num_points=4096):
+    # 把filenames中的.bin打包到folder，缺失或点数不对的文件不打包，读取时仍走逐文件的路径
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    filenames = list(dict.fromkeys(filenames))
+    valid = []
+    for filename in filenames:
+        path = os.path.join(dataset_folder, filename)
+        if os.path.exists(path) and os.path.getsize(path) == num_points * 3 * 8:
+            valid.append(filename)
+        else:
+            print("skip " + filename)
+
+    # 先写到临时文件，写完再替换，避免训练进程读到一半的仓库
+    tmp_points = os.path.join(folder, POINTS_FILE + ".tmp")
+    points = np.lib.format.open_memmap(tmp_points, mode='w+', dtype=np.float32,
+                                       shape=(len(valid), num_points, 3))
+    index = {}
+    for row, filename in enumerate(valid):
+        pc = np.fromfile(os.path.join(dataset_folder, filename), dtype=np.float64)
+        points[row] = pc.reshape(num_points, 3)
+        index[filename] = row
+    points.flush()
+    del points
+    tmp_index = os.path.join(folder, INDEX_FILE + ".tmp")
+    with open(tmp_index, 'wb') as handle:
+        pickle.dump(index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_points, os.path.join(folder, POINTS_FILE))
+    os.replace(tmp_index, os.path.join(folder, INDEX_FILE))
+    print("Done ", folder, len(index))
+    return len(index)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from tqdm import tqdm
+
+# 只做前向时inference_mode比no_grad省去版本计数，旧版本torch没有则退回no_grad
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+def batch_slices(num, batch_size):
+    # 最后一个不满的batch也单独作为一个slice，不需要另外处理edge case
+    return [slice(start, min(start + batch_size, num)) for start in range(0, num, batch_size)]
+
+
+def to_tensor(queries, pin_memory=False):
+    # [B,4096,3] -> [B,1,4096,3]，在加载线程里完成拷贝和类型转换
+    feed_tensor = torch.from_numpy(np.ascontiguousarray(queries, dtype=np.float32)).unsqueeze(1)
+    if pin_memory:
+        feed_tensor = feed_tensor.pin_memory()
+    return feed_tensor
+
+
+def prefetch(load_fn, chunks, depth=2, num_threads=2):
+    # 对每个chunk给出load_fn(chunk)，线程池最多提前读取depth个，读盘与当前batch的前向重叠；depth=0时同步读取
+    if depth <= 0:
+        for chunk in chunks:
+            yield load_fn(chunk)
+        return
+    chunks = iter(chunks)
+    with ThreadPoolExecutor(max(num_threads, 1)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(load_fn, chunk))
+            if len(pending) >= depth:
+                break
+        while pending:
+            batch = pending.popleft().result()
+            chunk = next(chunks, None)
+            if chunk is not None:
+                pending.append(pool.submit(load_fn, chunk))
+            yield batch
+
+
+def embed(model, load_fn, num, batch_size, device, depth=2, num_threads=2, tqdm_flag=False):
+    # num个子图的描述子 [num, D]，第s个batch为load_fn(s)返回的[B,4096,3]，模型运行时用prefetch预读下一批
+    pin_memory = device.type == "cuda"
+    slices = batch_slices(num, batch_size)
+    batches = prefetch(lambda s: to_tensor(load_fn(s), pin_memory), slices, depth, num_threads)
+    outputs = []
+    with inference_mode():
+        for feed_tensor in tqdm(batches, total=len(slices), disable=not tqdm_flag):
+            out = model(feed_tensor.to(device, non_blocking=True))
+            outputs.append(out.detach().cpu().numpy().reshape(feed_tensor.shape[0], -1))
+    if len(outputs) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.concatenate(outputs)
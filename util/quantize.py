@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+from util.PointNetVlad import NetVLADLoupe
+from util.pipeline import inference_mode, to_tensor
+
+# 旧版本torch中动态量化模块在torch.nn.quantized.dynamic
+try:
+    import torch.ao.nn.quantized.dynamic as nnqd
+except ImportError:
+    import torch.nn.quantized.dynamic as nnqd
+
+
+class PointwiseLinear(nn.Module):
+    # 1x1的Conv1d/Conv2d写成通道维上的nn.Linear，动态量化才能作用于它
+    def __init__(self, conv):
+        super(PointwiseLinear, self).__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data.copy_(conv.weight.data.flatten(1))
+        if conv.bias is not None:
+            self.linear.bias.data.copy_(conv.bias.data)
+
+    # input [B,C,num] or [B,C,num,k]
+    def forward(self, x):
+        return self.linear(x.transpose(1, -1)).transpose(1, -1).contiguous()
+
+
+def is_pointwise_conv(module):
+    return isinstance(module, (nn.Conv1d, nn.Conv2d)) and module.groups == 1 and \
+        all(size == 1 for size in module.kernel_size)
+
+
+def hidden_linear(loupe):
+    # NetVLAD的降维矩阵vlad @ hidden1_weights写成nn.Linear
+    def linear(weights):
+        layer = nn.Linear(weights.size(0), weights.size(1), bias=False)
+        layer.weight.data.copy_(weights.data.t())
+        return layer
+    if loupe.hidden_rank > 0:
+        hidden1 = nn.Sequential(linear(loupe.hidden1_weights_u), linear(loupe.hidden1_weights_v))
+        del loupe.hidden1_weights_u, loupe.hidden1_weights_v
+    else:
+        hidden1 = linear(loupe.hidden1_weights)
+        del loupe.hidden1_weights
+    return hidden1
+
+
+def linearize(model):
+    # cpu上fp32的模型副本，1x1卷积和NetVLAD的hidden权重换成nn.Linear；edge_conv要读权重的卷积保持不变
+    model = copy.deepcopy(getattr(model, "module", model)).cpu().eval()
+    # 动态量化的层不能再套autocast
+    model.amp_dtype = None
+    modules = dict(model.named_modules())
+    skip = set()
+    for name, module in modules.items():
+        for child in getattr(module, "edge_convs", ()):
+            skip.add((name + "." if name else "") + child + ".0")
+    for name, module in modules.items():
+        parent_name, _, child = name.rpartition(".")
+        if name not in skip and is_pointwise_conv(module):
+            setattr(modules[parent_name], child, PointwiseLinear(module))
+        elif isinstance(module, NetVLADLoupe) and module.hidden1 is None:
+            module.hidden1 = hidden_linear(module)
+    return model
+
+
+def describe(model, clouds, batch_size=16):
+    # clouds [N,num_points,3] -> [N,D]
+    outputs = []
+    with inference_mode():
+        for start in range(0, len(clouds), batch_size):
+            outputs.append(model(to_tensor(clouds[start:start + batch_size])).numpy())
+    return np.concatenate(outputs)
+
+
+def cosine_similarity(a, b):
+    return (a * b).sum(-1) / np.maximum(np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1), 1e-12)
+
+
+def quantize_model(model, calib_clouds=None, tolerance=0.0, log_fn=print):
+    # cpu推理用的动态int8模型：每个nn.Linear的权重为int8，激活在运行时逐batch量化
+    # 给出calib_clouds [N,num_points,3]且tolerance > 0时逐层单独量化，只保留描述子与fp32的平均余弦相似度不低于1 - tolerance的层
+    # 返回模型和被量化的层名
+    model = linearize(model)
+    names = [name for name, module in model.named_modules() if isinstance(module, nn.Linear)]
+    if calib_clouds is not None and tolerance > 0:
+        reference = describe(model, calib_clouds)
+        modules = dict(model.named_modules())
+        keep = []
+        for name in names:
+            # 原地替换单层测量误差，不复制整个模型（hidden1_weights可达1GB）
+            parent_name, _, child = name.rpartition(".")
+            layer = modules[name]
+            layer.qconfig = torch.quantization.default_dynamic_qconfig
+            setattr(modules[parent_name], child, nnqd.Linear.from_float(layer))
+            similarity = cosine_similarity(reference, describe(model, calib_clouds)).mean()
+            setattr(modules[parent_name], child, layer)
+            del layer.qconfig
+            log_fn("int8 " + name + " cosine similarity: " + str(round(float(similarity), 5)))
+            if similarity >= 1 - tolerance:
+                keep.append(name)
+        names = keep
+    model = torch.quantization.quantize_dynamic(model, set(names), dtype=torch.qint8, inplace=True)
+    return model, names
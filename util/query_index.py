@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+class CSRSet(object):
+    # 每行一个有序的列序号集合，以CSR的ptr/idx数组保存
+    # 大量(row, col)的成员查询展平成row * num_cols + col后一次二分查找
+    def __init__(self, ptr, idx, num_cols):
+        self.ptr = np.asarray(ptr, dtype=np.int64)
+        self.idx = np.asarray(idx, dtype=np.int32)
+        self.num_cols = int(num_cols)
+        rows = np.repeat(np.arange(len(self.ptr) - 1, dtype=np.int64), np.diff(self.ptr))
+        self.keys = rows * self.num_cols + self.idx
+
+    @classmethod
+    def from_lists(cls, lists, num_cols):
+        counts = np.array([len(l) for l in lists], dtype=np.int64)
+        ptr = np.zeros(len(lists) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum(counts)
+        idx = np.zeros(ptr[-1], dtype=np.int32)
+        for i, l in enumerate(lists):
+            idx[ptr[i]:ptr[i + 1]] = np.sort(np.asarray(l, dtype=np.int32))
+        return cls(ptr, idx, num_cols)
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def row(self, i):
+        return self.idx[self.ptr[i]:self.ptr[i + 1]]
+
+    def counts(self, rows=None):
+        counts = np.diff(self.ptr)
+        if rows is None:
+            return counts
+        return counts[rows]
+
+    def contains(self, rows, cols):
+        # rows和cols可以广播，返回同形状的bool数组
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))
+        if len(self.keys) == 0:
+            return np.zeros(rows.shape, dtype=bool)
+        keys = rows * self.num_cols + cols
+        pos = np.searchsorted(self.keys, keys)
+        pos = np.minimum(pos, len(self.keys) - 1)
+        return self.keys[pos] == keys
+
+
+class QueryIndex(object):
+    # 用数组代替每个query的python列表保存训练元组
+    # positives为正样本半径以内的子图（不含query自身），neighbors为负样本半径以内的所有子图（含query），neighbors以外都是负样本
+    def __init__(self, files, positives, neighbors):
+        self.files = np.asarray(files, dtype=object)
+        self.positives = positives
+        self.neighbors = neighbors
+
+    def __len__(self):
+        return len(self.files)
+
+    def save(self, filename):
+        # 只保存CSR数组，负样本是隐式的（50m以外都是）
+        np.savez(filename, files=self.files.astype(str),
+                 pos_ptr=self.positives.ptr, pos_idx=self.positives.idx,
+                 nbr_ptr=self.neighbors.ptr, nbr_idx=self.neighbors.idx)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        num = len(data["files"])
+        positives = CSRSet(data["pos_ptr"], data["pos_idx"], num)
+        neighbors = CSRSet(data["nbr_ptr"], data["nbr_idx"], num)
+        return cls(data["files"], positives, neighbors)
+
+    @classmethod
+    def from_radius(cls, files, ind_pos, ind_nbr):
+        # ind_pos/ind_nbr为KDTree.query_radius在正样本半径和负样本半径下的结果
+        num = len(files)
+        positives = CSRSet.from_lists([np.setdiff1d(ind_pos[i], [i]) for i in range(num)], num)
+        neighbors = CSRSet.from_lists(ind_nbr, num)
+        return cls(files, positives, neighbors)
+
+    @classmethod
+    def from_queries_dict(cls, queries):
+        # key:{'query':file,'positives':[keys],'negatives':[keys]}
+        num = len(queries.keys())
+        files = [queries[i]["query"] for i in range(num)]
+        positives = CSRSet.from_lists([queries[i]["positives"] for i in range(num)], num)
+        neighbors = []
+        for i in range(num):
+            # 负样本的补集就是50m以内的邻居
+            mask = np.ones(num, dtype=bool)
+            mask[np.asarray(queries[i]["negatives"], dtype=np.int64)] = False
+            neighbors.append(np.flatnonzero(mask))
+        neighbors = CSRSet.from_lists(neighbors, num)
+        return cls(files, positives, neighbors)
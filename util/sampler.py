@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+def first_valid(candidates, valid, num):
+    # 每行取前num个valid的候选，返回[B,num]和每行是否足够的mask [B]
+    order = np.argsort(~valid, axis=1, kind='stable')[:, :num]
+    picked = np.take_along_axis(candidates, order, axis=1)
+    enough = np.take_along_axis(valid, order, axis=1).all(axis=1)
+    return picked, enough
+
+
+def unique_in_row(candidates):
+    # 每行中第一次出现的位置为True，重复的为False
+    order = np.argsort(candidates, axis=1, kind='stable')
+    ordered = np.take_along_axis(candidates, order, axis=1)
+    first = np.ones(candidates.shape, dtype=bool)
+    first[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    unique = np.empty(candidates.shape, dtype=bool)
+    np.put_along_axis(unique, order, first, axis=1)
+    return unique
+
+
+class TupleSampler(object):
+    # 一次为整个batch的query抽取(positives, negatives, other_neg)的序号
+    # 负样本是neighbors以外的所有子图，均匀随机抽取后用向量化的成员查询剔除，不再打乱每个query的列表
+    # other_neg不是query及其任何负样本的正样本
+    def __init__(self, queries, num_pos, num_neg, oversample=4, max_tries=20):
+        self.queries = queries
+        self.num_pos = num_pos
+        self.num_neg = num_neg
+        self.num = len(queries)
+        self.oversample = oversample
+        self.max_tries = max_tries
+
+    def valid_queries(self):
+        # 正样本不足的query不参与训练
+        return np.flatnonzero(self.queries.positives.counts() >= self.num_pos)
+
+    def sample_positives(self, items, num=None):
+        if num is None:
+            num = self.num_pos
+        positives = self.queries.positives
+        counts = positives.counts(items)
+        width = max(int(counts.max()), num)
+        # 每行随机打分，超出该行长度的位置排到最后，取前num个即无放回抽样
+        scores = np.random.random_sample((len(items), width))
+        scores[np.arange(width)[None, :] >= counts[:, None]] = np.inf
+        order = np.argsort(scores, axis=1)[:, :num]
+        return positives.idx[positives.ptr[items][:, None] + order].astype(np.int64)
+
+    def sample_negatives(self, items, num, exclude=None):
+        # 每个query抽num个互不相同的负样本，且不在exclude [B,E]中
+        items = np.asarray(items, dtype=np.int64)
+        negatives = np.zeros((len(items), num), dtype=np.int64)
+        todo = np.arange(len(items))
+        width = num * self.oversample + 8
+        for _ in range(self.max_tries):
+            candidates = np.random.randint(0, self.num, size=(len(todo), width))
+            valid = ~self.queries.neighbors.contains(items[todo][:, None], candidates)
+            if exclude is not None and exclude.shape[1] > 0:
+                valid &= ~(candidates[:, :, None] == exclude[todo][:, None, :]).any(axis=2)
+            valid &= unique_in_row(candidates)
+            picked, enough = first_valid(candidates, valid, num)
+            negatives[todo[enough]] = picked[enough]
+            todo = todo[~enough]
+            if len(todo) == 0:
+                return negatives
+            width *= 2
+        # 随机抽样多次仍不够，说明负样本本身就很少，直接枚举
+        for t in todo:
+            pool = np.flatnonzero(~self.queries.neighbors.contains(items[t], np.arange(self.num)))
+            if exclude is not None:
+                pool = np.setdiff1d(pool, exclude[t])
+            negatives[t] = np.random.choice(pool, num, replace=len(pool) < num)
+        return negatives
+
+    def sample_other_neg(self, items, negatives):
+        items = np.asarray(items, dtype=np.int64)
+        positives = self.queries.positives
+        # query和它的负样本，other_neg不能是其中任何一个的正样本
+        anchors = np.concatenate((items[:, None], negatives), axis=1)
+        other_neg = np.zeros(len(items), dtype=np.int64)
+        todo = np.arange(len(items))
+        width = self.oversample
+        for _ in range(self.max_tries):
+            candidates = np.random.randint(0, self.num, size=(len(todo), width))
+            # 正样本关系是对称的，查candidate的正样本里有没有anchor
+            valid = ~positives.contains(candidates[:, :, None], anchors[todo][:, None, :]).any(axis=2)
+            valid &= candidates != items[todo][:, None]
+            picked, enough = first_valid(candidates, valid, 1)
+            other_neg[todo[enough]] = picked[enough, 0]
+            todo = todo[~enough]
+            if len(todo) == 0:
+                return other_neg
+            width *= 2
+        for t in todo:
+            other_neg[t] = self.sample_negatives(items[t:t + 1], 1)[0, 0]
+        return other_neg
+
+    def sample(self, items, hard_negs=None):
+        # 返回positives [B,num_pos]、negatives [B,num_neg]和other_neg [B]；hard_negs [B,H]放在负样本最前面，其余随机补齐
+        items = np.asarray(items, dtype=np.int64)
+        positives = self.sample_positives(items)
+        if hard_negs is None or hard_negs.shape[1] == 0:
+            negatives = self.sample_negatives(items, self.num_neg)
+        else:
+            hard_negs = np.asarray(hard_negs, dtype=np.int64)[:, :self.num_neg]
+            rest = self.sample_negatives(items, self.num_neg - hard_negs.shape[1], exclude=hard_negs)
+            negatives = np.concatenate((hard_negs, rest), axis=1)
+        other_neg = self.sample_other_neg(items, negatives)
+        return positives, negatives, other_neg